@@ -0,0 +1,106 @@
+import time
+
+
+class AdaptiveController:
+    """
+    Closed-loop controller that holds a latency or FPS target by moving along a ladder of processing levels.
+    Each level sets the processing width, the frame interval (one frame in frame_interval is processed, the others
+    reuse its results) and the minimum face size for detectMultiScale. Levels are ordered from the most expensive
+    to the cheapest. The controller smooths the measured latency of processed frames and the time per frame, and
+    steps one level cheaper when the measurement is above the target by more than tolerance, or one level more
+    expensive when it is below. At least adjust_every frames pass between two steps
+    """
+
+    def __init__(self, conf):
+        """
+        :param conf: configuration file, its "adaptive" section configures the controller
+        """
+        adaptive_conf = conf["adaptive"]
+        self.levels = adaptive_conf["levels"]
+        self.target_latency = adaptive_conf["target_latency"]
+        self.target_fps = adaptive_conf["target_fps"]
+        self.tolerance = adaptive_conf["tolerance"]
+        self.adjust_every = adaptive_conf["adjust_every"]
+        self.smoothing = adaptive_conf["smoothing"]
+
+        self.level = adaptive_conf["start_level"]
+        self.latency = None
+        self.frame_time = None
+        self.frames = 0
+        self.last_adjustment = 0
+        self.step_downs = 0
+        self.step_ups = 0
+        self.level_frames = [0] * len(self.levels)
+
+    @property
+    def frame_width(self):
+        return self.levels[self.level]["frame_width"]
+
+    @property
+    def frame_interval(self):
+        return self.levels[self.level]["frame_interval"]
+
+    @property
+    def min_face_size(self):
+        return self.levels[self.level]["min_face_size"]
+
+    def smooth(self, average, value):
+        return value if average is None else (1 - self.smoothing) * average + self.smoothing * value
+
+    def get_error(self):
+        """
+        :return: (measured, target) of the controlled quantity, seconds per frame or latency in seconds
+        """
+        if self.target_fps > 0:
+            return self.frame_time, 1 / float(self.target_fps)
+        return self.latency, self.target_latency
+
+    def update(self, timestamp, processed):
+        """
+        Called at the end of every frame that was not skipped as duplicate or idle
+        :param timestamp: time the frame was read
+        :param processed: True if detection and recognition ran on the frame
+        :return: True if the level changed, the caller then applies the new settings
+        """
+        elapsed = time.time() - timestamp
+        if processed:
+            self.latency = self.smooth(self.latency, elapsed)
+        # the loop is serial, so the time spent on a frame bounds the frame rate
+        self.frame_time = self.smooth(self.frame_time, elapsed)
+        self.frames += 1
+        self.level_frames[self.level] += 1
+
+        measured, target = self.get_error()
+        if measured is None or self.frames - self.last_adjustment < self.adjust_every:
+            return False
+        if measured > target * (1 + self.tolerance) and self.level < len(self.levels) - 1:
+            self.level += 1
+            self.step_downs += 1
+        elif measured < target * (1 - self.tolerance) and self.level > 0:
+            self.level -= 1
+            self.step_ups += 1
+        else:
+            return False
+        self.last_adjustment = self.frames
+        return True
+
+    def get_stats(self):
+        return {"Level": self.level,
+                "Frame_width": self.frame_width,
+                "Frame_interval": self.frame_interval,
+                "Min_face_size": self.min_face_size,
+                "Smoothed_latency": self.latency,
+                "Smoothed_fps": 1 / self.frame_time if self.frame_time else 0,
+                "Quality_step_downs": self.step_downs,
+                "Quality_step_ups": self.step_ups,
+                "Frames_per_level": list(self.level_frames)}
+
+
+def create_adaptive_controller(conf):
+    """
+    :param conf: configuration file
+    :return: AdaptiveController configured by conf["adaptive"], or None if disabled
+    """
+    if not conf["adaptive"]["enabled"]:
+        return None
+    return AdaptiveController(conf)
@@ -0,0 +1,251 @@
+import argparse
+import hashlib
+import os
+import time
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbour index over 128-length encodings.
+    The gallery is partitioned into num_cells cells by k-means, and a query only computes distances to the
+    encodings of the num_probes cells with the closest centroids. More probes = better recall, higher latency
+    """
+    VERSION = 1
+
+    def __init__(self, num_cells=64, num_probes=4, iterations=10, seed=0):
+        """
+        :param num_cells: number of k-means cells the gallery is partitioned into
+        :param num_probes: number of cells searched per query
+        :param iterations: number of k-means iterations when building
+        :param seed: seed of the k-means initialization
+        """
+        self.num_cells = num_cells
+        self.num_probes = num_probes
+        self.iterations = iterations
+        self.seed = seed
+
+        self.centroids = None
+        self.order = None
+        self.cell_offsets = None
+        self.encodings = None
+        self.squared_norms = None
+        self.fingerprint = ""
+
+    @staticmethod
+    def get_fingerprint(encodings):
+        """
+        :param encodings: gallery matrix
+        :return: sha1 hex digest identifying the gallery the index was built from
+        """
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+        return hashlib.sha1(encodings.tobytes()).hexdigest()
+
+    @staticmethod
+    def get_squared_distances(queries, points, point_norms):
+        squared = np.einsum("ij,ij->i", queries, queries)[:, None] + point_norms[None, :] \
+            - 2 * queries.dot(points.T)
+        return np.maximum(squared, 0, out=squared)
+
+    def assign(self, points, centroids, chunk_size=8192):
+        """
+        Finds the closest centroid of every point, in chunks to bound memory use
+        :return: array of cell indexes
+        """
+        centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+        cells = np.empty(len(points), dtype=np.int32)
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start + chunk_size]
+            cells[start:start + chunk_size] = np.argmin(self.get_squared_distances(chunk, centroids, centroid_norms),
+                                                        axis=1)
+        return cells
+
+    def train(self, encodings, max_samples_per_cell=256):
+        """
+        Runs k-means on a sample of the encodings
+        :param encodings: gallery matrix
+        :param max_samples_per_cell: bounds the training sample to num_cells * max_samples_per_cell encodings
+        :return: centroids of shape (num_cells, 128), no centroids for an empty gallery
+        """
+        rng = np.random.RandomState(self.seed)
+        num_cells = min(self.num_cells, len(encodings))
+        if num_cells == 0:
+            return np.zeros((0, 128), dtype=np.float32)
+        sample_size = min(len(encodings), num_cells * max_samples_per_cell)
+        sample = encodings[rng.choice(len(encodings), sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, num_cells, replace=False)].copy()
+
+        for _ in range(self.iterations):
+            cells = self.assign(sample, centroids)
+            counts = np.bincount(cells, minlength=num_cells)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, cells, sample)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty][:, None]
+            # re-seed empty cells with random samples so no cell stays unused
+            empty = np.nonzero(~non_empty)[0]
+            if len(empty) > 0:
+                centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        return centroids
+
+    def build(self, encodings):
+        """
+        Partitions the encodings into inverted lists
+        :param encodings: gallery matrix of shape (gallery size, 128)
+        :return: self
+        """
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, 128)
+        self.fingerprint = self.get_fingerprint(encodings)
+        self.centroids = self.train(encodings)
+        cells = self.assign(encodings, self.centroids)
+        self.order = np.argsort(cells, kind="mergesort").astype(np.int32)
+        self.cell_offsets = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=len(self.centroids)))))
+        self.set_encodings(encodings)
+        return self
+
+    def set_encodings(self, encodings):
+        """
+        Stores the encodings in inverted list order, so every cell is a contiguous block
+        :param encodings: gallery matrix the index was built from
+        :return: None
+        """
+        self.encodings = np.ascontiguousarray(encodings[self.order])
+        self.squared_norms = np.einsum("ij,ij->i", self.encodings, self.encodings)
+
+    def get_candidates(self, query):
+        """
+        :param query: 128-length encoding
+        :return: positions, in inverted list order, of the encodings in the probed cells
+        """
+        num_probes = min(self.num_probes, len(self.centroids))
+        if num_probes == 0:
+            return np.zeros(0, dtype=np.int64)
+        centroid_distances = np.einsum("ij,ij->i", self.centroids - query, self.centroids - query)
+        cells = np.argpartition(centroid_distances, num_probes - 1)[:num_probes]
+        return np.concatenate([np.arange(self.cell_offsets[c], self.cell_offsets[c + 1]) for c in cells])
+
+    def search(self, queries, k):
+        """
+        Finds the approximate k nearest gallery encodings of every query
+        :param queries: matrix of shape (number of faces, 128)
+        :param k: number of neighbours
+        :return: (indexes, distances) of shape (number of faces, k). indexes refer to the gallery the index was
+                built from, missing neighbours have index -1 and distance inf
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, 128)
+        indexes = np.full((len(queries), k), -1, dtype=np.int32)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            candidates = self.get_candidates(query)
+            squared = self.get_squared_distances(query[None, :], self.encodings[candidates],
+                                                 self.squared_norms[candidates])[0]
+            count = min(k, len(candidates))
+            if count == 0:
+                continue
+            nearest = np.argpartition(squared, count - 1)[:count]
+            nearest = nearest[np.argsort(squared[nearest])]
+            indexes[i, :count] = self.order[candidates[nearest]]
+            distances[i, :count] = np.sqrt(squared[nearest])
+        return indexes, distances
+
+    def save(self, path):
+        """
+        Writes the index beside the gallery. The encodings themselves are not stored
+        :param path: .npz file to write
+        :return: None
+        """
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as index_file:
+            np.savez(index_file,
+                     version=np.array(self.VERSION),
+                     fingerprint=np.array(self.fingerprint),
+                     centroids=self.centroids,
+                     order=self.order,
+                     cell_offsets=self.cell_offsets)
+        os.rename(tmp_path, path)
+
+    def load(self, path, encodings):
+        """
+        Loads a saved index for the given gallery
+        :param path: .npz file to read
+        :param encodings: gallery matrix, must be the one the index was built from
+        :return: True if the index was loaded, False if it is missing or built from another gallery
+        """
+        if not os.path.isfile(path):
+            return False
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, 128)
+        with np.load(path) as data:
+            if int(data["version"]) != self.VERSION or str(data["fingerprint"]) != self.get_fingerprint(encodings):
+                return False
+            self.centroids = data["centroids"]
+            self.order = data["order"]
+            self.cell_offsets = data["cell_offsets"]
+        self.fingerprint = self.get_fingerprint(encodings)
+        self.set_encodings(encodings)
+        return True
+
+    @classmethod
+    def load_or_build(cls, path, encodings, num_cells, num_probes):
+        """
+        Loads the index saved at path, rebuilding and saving it if it is missing or stale
+        :return: IVFIndex for the given gallery
+        """
+        index = cls(num_cells=num_cells, num_probes=num_probes)
+        if not index.load(path, encodings):
+            index.build(encodings)
+            index.save(path)
+        return index
+
+
+def make_synthetic_gallery(num_users, faces_per_user, seed=0):
+    """
+    Creates clustered encodings resembling a gallery: a random center per user with small per-image noise
+    :return: (encodings, user_ids)
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_users, 128).astype(np.float32) * 0.1
+    user_ids = np.repeat(np.arange(1, num_users + 1), faces_per_user)
+    encodings = centers[user_ids - 1] + rng.randn(len(user_ids), 128).astype(np.float32) * 0.02
+    return encodings, user_ids
+
+
+def benchmark(gallery_sizes, num_cells, num_probes, neighbours, faces_per_user=10, num_queries=200):
+    """
+    Prints query latency and recall of the index against brute force matching for each gallery size
+    :return: None
+    """
+    import gallery_matcher
+    print "{0:>8} {1:>14} {2:>14} {3:>10} {4:>10}".format("gallery", "brute (ms/q)", "ivf (ms/q)", "build (s)",
+                                                          "recall@1")
+    for size in gallery_sizes:
+        encodings, user_ids = make_synthetic_gallery(size // faces_per_user, faces_per_user)
+        rng = np.random.RandomState(1)
+        queries = encodings[rng.choice(len(encodings), num_queries)] \
+            + rng.randn(num_queries, 128).astype(np.float32) * 0.02
+
+        brute = gallery_matcher.GalleryMatcher(encodings, user_ids)
+        start = time.time()
+        expected = [brute.match(query[None, :])[0][0] for query in queries]
+        brute_time = (time.time() - start) / num_queries
+
+        approximate = gallery_matcher.GalleryMatcher(encodings, user_ids, neighbours=neighbours)
+        start = time.time()
+        approximate.index = IVFIndex(num_cells=num_cells, num_probes=num_probes).build(approximate.encodings)
+        build_time = time.time() - start
+        start = time.time()
+        found = [approximate.match(query[None, :])[0][0] for query in queries]
+        ivf_time = (time.time() - start) / num_queries
+
+        recall = np.mean(np.array(found) == np.array(expected))
+        print "{0:>8} {1:>14.3f} {2:>14.3f} {3:>10.2f} {4:>10.3f}".format(size, brute_time * 1000, ivf_time * 1000,
+                                                                          build_time, recall)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the approximate nearest neighbour gallery index")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--cells", type=int, default=256)
+    parser.add_argument("--probes", type=int, default=8)
+    parser.add_argument("--neighbours", type=int, default=32)
+    args = parser.parse_args()
+    benchmark(args.sizes, args.cells, args.probes, args.neighbours)
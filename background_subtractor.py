@@ -1,11 +1,20 @@
+import argparse
+import copy
+import json
 import cv2
+import numpy as np
 import time
 import os
 import face_recognition
+import face_tracker
+import frame_context
 import utility
 
 
 class BackgroundExtractor:
+    # smallest faces, in pixels, found by dlib's frontal face detector without upsampling and by the cascades
+    DLIB_MIN_FACE = 80
+    CASCADE_MIN_FACE = 24
 
     def __init__(self, first_frame, conf, path_to_file):
         """
@@ -17,25 +26,60 @@ class BackgroundExtractor:
                 1: use dlib's frontal face detector
                 2: use LBP cascade detector
                 3: use haar cascade detector
+                4: use LBP cascade proposals confirmed by dlib's frontal face detector
         """
         gray = cv2.cvtColor(first_frame, cv2.COLOR_BGR2GRAY)
         gray = cv2.GaussianBlur(gray, (21, 21), 0)
 
         self.avg = gray.copy().astype("float")
+        self.mixture = MixtureBackgroundModel(gray, conf) if conf["background_model"]["type"] == "mixture" else None
+        self.last_faces = []
+        # 8-bit copy of the running average, only refreshed when accumulate_background changes it
+        self.avg_8u = cv2.convertScaleAbs(self.avg)
         self.current_frame = self.avg
+        # per-frame work images, reused for every frame of the same size
+        self.buffers = None
+        self.buffer_allocations = 0
         self.motion_threshold = conf["motion_threshold"]
 
         self.do_bg_subtraction = conf["do_bgsub"]
         self.face_detection_method = None
         self.face_cascade = None
         self.face_detection_algorithm = None
+        two_stage_conf = conf["two_stage_detection"]
+        self.proposal_scale = two_stage_conf["proposal_scale"]
+        self.proposal_neighbours = two_stage_conf["proposal_neighbours"]
+        self.confirm_padding = two_stage_conf["confirm_padding"]
+        self.confirm_upsample = two_stage_conf["confirm_upsample"]
+        self.cascade_stats = {"Proposals": 0, "Confirmations": 0, "Confirmed": 0}
+        self.dlib_scale = self.dlib_upsample = self.cascade_scale = None
+        prior_conf = conf["prior_search"]
+        # the motion regions already limit the search with background subtraction, where priors mostly cost time
+        self.prior_search = prior_conf["enabled"] and (not conf["do_bgsub"] or prior_conf["with_bgsub"])
+        self.prior_expansions = prior_conf["expansions"]
+        self.full_scan_interval = prior_conf["full_scan_interval"]
+        self.priors = []
+        self.last_full_scan = 0
+        self.prior_stats = {"Hits": 0, "Misses": 0, "Full_scans": 0}
+        self.set_detection_scale(conf["detection_scale"])
         self.load_face_detection_algorithm(path_to_file, conf)
 
         self.negative_seconds_limit = conf["consecutive_negative_seconds_limit"]
         self.previous_positive_detection = time.time() - self.negative_seconds_limit
         self.min_area = conf["min_area"]
+        self.min_face_size = 30
         self.show_feed = conf["show_video"]
+        self.headless = conf["headless"]
+        self.preview = None
         self.is_dynamic = conf["dynamic_background"]
+        self.motion_regions = 0
+        self.motion_context = None
+        self.motion_areas = []
+        region_conf = conf["motion_regions"]
+        self.region_padding = region_conf["padding"]
+        self.merge_distance = region_conf["merge_distance"]
+        self.full_frame_coverage = region_conf["full_frame_coverage"]
+        self.region_stats = {"Frames": 0, "Contours": 0, "Regions": 0, "Full_frame": 0}
         self.performance_stats = {"Detection": [], "Total_detection_time": []}
 
     def load_face_detection_algorithm(self, path_to_file, conf):
@@ -47,6 +91,7 @@ class BackgroundExtractor:
             1: use dlib's frontal face detector
             2: use LBP cascade detector
             3: use haar cascade detector
+            4: use LBP cascade proposals confirmed by dlib's frontal face detector
         :param path_to_file: directory of working directory
         :param conf: configuration file
         :return: None
@@ -61,6 +106,9 @@ class BackgroundExtractor:
         elif algorithm == 3:
             self.face_detection_method = self.find_faces_haar
             self.face_cascade = cv2.CascadeClassifier(os.path.join(path_to_file, conf["haar_cascade_path"]))
+        elif algorithm == 4:
+            self.face_detection_method = self.find_faces_two_stage
+            self.face_cascade = cv2.CascadeClassifier(os.path.join(path_to_file, conf["lbp_cascade_path"]))
 
     @staticmethod
     def get_algorithm_text(algorithm):
@@ -73,98 +121,313 @@ class BackgroundExtractor:
             return "Dlib HOG"
         elif algorithm == 2:
             return "LBP Cascade"
+        elif algorithm == 4:
+            return "LBP Cascade + Dlib HOG"
         else:
             return "Haar Cascade"
 
     def get_performance_stats(self):
+        frames = float(max(1, self.region_stats["Frames"]))
         return {"Detection": utility.list_avg(self.performance_stats["Detection"]),
-                "Total_detection": utility.list_avg(self.performance_stats["Total_detection_time"])}
+                "Total_detection": utility.list_avg(self.performance_stats["Total_detection_time"]),
+                "Detector_calls_before_planning": self.region_stats["Contours"] / frames,
+                "Detector_calls_per_frame": self.region_stats["Regions"] / frames,
+                "Full_frame_detections": self.region_stats["Full_frame"],
+                "Proposals": self.cascade_stats["Proposals"],
+                "Confirmed_proposals": self.cascade_stats["Confirmed"],
+                "Confirmation_crops": self.cascade_stats["Confirmations"],
+                "Prior_hits": self.prior_stats["Hits"],
+                "Prior_misses": self.prior_stats["Misses"],
+                "Full_scans": self.prior_stats["Full_scans"]}
+
+    def attach_preview(self, preview):
+        """
+        Streams the "blur", "average", "contour" and "detection" phases on the preview server
+        :param preview: preview_server.PreviewServer
+        :return: None
+        """
+        self.preview = preview
+        for view in ("blur", "average", "contour"):
+            preview.add_view(view)
+        preview.add_view("detection", self.draw_regions)
+
+    def wants_view(self, view):
+        """
+        :param view: name of a phase in conf.json "show_video"
+        :return: True if the phase is displayed in a window or watched on the preview server
+        """
+        if self.preview is not None and self.preview.is_watched(view):
+            return True
+        return not self.headless and self.show_feed[view]
+
+    def show_view(self, view, window, image):
+        """
+        Displays a phase in its window unless headless, and hands it to the preview server if it is watched
+        :param view: name of a phase in conf.json "show_video"
+        :param window: title of the highgui window
+        :param image: image, or the argument tuple of the view's renderer for "detection"
+        :return: None
+        """
+        if self.preview is not None and self.preview.is_watched(view):
+            # the buffers are reused by the next frame while the preview server encodes in its own thread
+            self.preview.publish(view, image.copy() if isinstance(image, np.ndarray) else image)
+        if not self.headless and self.show_feed[view]:
+            cv2.imshow(window, self.draw_regions(*image) if view == "detection" else image)
+
+    @staticmethod
+    def draw_regions(frame, regions):
+        """
+        :param frame: image the regions were found in
+        :param regions: list of bounding boxes (x, y, w, h)
+        :return: copy of the frame with the regions drawn
+        """
+        frame = frame.copy()
+        for x, y, w, h in regions:
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 255, 0), 2)
+        return frame
+
+    def get_buffers(self, shape):
+        """
+        :param shape: shape of the grayscale frame
+        :return: dictionary of preallocated 8-bit images of that shape, allocated anew only when the shape changes
+        """
+        if self.buffers is None or self.buffers["gray"].shape != shape:
+            self.buffers = {name: np.empty(shape, dtype=np.uint8) for name in ("gray", "blurred", "delta", "mask")}
+            self.buffer_allocations += 1
+        return self.buffers
 
     def get_potential_regions(self, frame):
         """
         Extract regions that differ from background model.
         Small regions are filtered out by property self.min_area
-        Toggle conf.json properties "blur", "average", "contour", "detection" to display those phases
-        :param frame: input image to analyze
-        :return: A list of tuples in the form (cropped_image, original_bounding box)
+        Toggle conf.json properties "blur", "average", "contour", "detection" to display those phases,
+        unless running headless. The phases are only computed for display while someone is looking at them
+        The intermediate images are written to preallocated buffers, which are overwritten by the next frame
+        :param frame: input image to analyze, or its FrameContext
+        :return: A list of tuples in the form (cropped_image, original_bounding box), cropped from the detection image
         """
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
-        self.current_frame = gray
-
-        if self.show_feed["blur"]:
-            cv2.imshow('Blurred', gray)
+        context = frame_context.get_context(frame)
+        frame = context.frame
+        buffers = self.get_buffers(frame.shape[:2])
+        context.get_gray(dst=buffers["gray"])
+        blurred = context.get_blurred(dst=buffers["blurred"])
+        self.current_frame = blurred
+
+        if self.wants_view("blur"):
+            self.show_view("blur", 'Blurred', blurred)
+
+        if self.mixture is not None:
+            frame_delta = self.mixture.get_foreground(blurred, self.last_faces, learn=self.is_dynamic,
+                                                      dst=buffers["delta"])
+            if self.wants_view("average"):
+                background = cv2.convertScaleAbs(self.mixture.get_background())
+                self.show_view("average", 'Average', cv2.resize(background, (blurred.shape[1], blurred.shape[0])))
+        else:
+            if blurred.shape != self.avg.shape:
+                # the processing width changed, keep the learned background at the new size
+                self.avg = cv2.resize(self.avg, (blurred.shape[1], blurred.shape[0]), interpolation=cv2.INTER_AREA)
+                self.avg_8u = cv2.convertScaleAbs(self.avg)
 
-        frame_delta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+            frame_delta = cv2.absdiff(blurred, self.avg_8u, dst=buffers["delta"])
 
-        if self.show_feed["average"]:
-            cv2.imshow('Average', cv2.convertScaleAbs(self.avg))
+            if self.wants_view("average"):
+                self.show_view("average", 'Average', self.avg_8u)
 
-        thresh = cv2.threshold(frame_delta, self.motion_threshold, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.dilate(thresh, None, iterations=2)
+            cv2.threshold(frame_delta, self.motion_threshold, 255, cv2.THRESH_BINARY, dst=frame_delta)
+        thresh = cv2.dilate(frame_delta, None, dst=buffers["mask"], iterations=2)
 
-        if self.show_feed["contour"]:
-            cv2.imshow("Countor", thresh)
+        if self.wants_view("contour"):
+            self.show_view("contour", "Countor", thresh)
 
-        (cnts, _) = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,
+        # findContours may modify the mask, which is scratch space by now
+        (cnts, _) = cv2.findContours(thresh, cv2.RETR_EXTERNAL,
                                      cv2.CHAIN_APPROX_SIMPLE)
 
         areas = [x for x in cnts if cv2.contourArea(x) > self.min_area]
+        self.motion_regions = len(areas)
         cropped_images = []
-        for a in areas:
-            x, y, w, h = cv2.boundingRect(a)
-            cropped_images.append((frame[y:y + h, x:x + w], (x, y, w, h)))
+        image = self.get_detection_image(context)
+        for region in self.plan_regions([cv2.boundingRect(a) for a in areas], frame.shape):
+            cropped_images.append((context.crop(image, region), region))
 
-            if self.show_feed["detection"]:
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 255, 0), 2)
-                cv2.imshow('Video CONTOUR', frame)
+        if len(cropped_images) > 0 and self.wants_view("detection"):
+            self.show_view("detection", 'Video CONTOUR', (frame, [region for _, region in cropped_images]))
 
         return cropped_images
 
+    def plan_regions(self, boxes, frame_shape):
+        """
+        Pads the motion regions, so faces at their edges are not cut, and merges regions that overlap or are
+        close, so one moving person is searched once. If the result covers most of the frame, a single detection
+        over the full frame is cheaper than several over large crops
+        :param boxes: bounding boxes (x, y, w, h) of the motion contours
+        :param frame_shape: shape of the frame
+        :return: list of disjoint bounding boxes (x, y, w, h) to run the face detector on
+        """
+        regions = utility.merge_boxes([utility.pad_box(box, self.region_padding, frame_shape) for box in boxes],
+                                      self.merge_distance)
+        self.region_stats["Frames"] += 1
+        self.region_stats["Contours"] += len(boxes)
+        if sum(w * h for _, _, w, h in regions) > self.full_frame_coverage * frame_shape[0] * frame_shape[1]:
+            regions = [(0, 0, frame_shape[1], frame_shape[0])]
+            self.region_stats["Full_frame"] += 1
+        self.region_stats["Regions"] += len(regions)
+        return regions
+
+    def get_detection_image(self, context):
+        """
+        The cascades and the scaled dlib detector work on grayscale, so they get the shared grayscale view instead
+        of converting every region themselves. Dlib at full size and the two-stage detector use the color frame
+        :param context: FrameContext of the frame
+        :return: the frame or the view of it the detector runs on
+        """
+        if self.face_detection_algorithm in (2, 3) or (self.face_detection_algorithm == 1 and self.dlib_scale != 1):
+            return context.get_gray()
+        return context.frame
+
+    def set_detection_scale(self, scale_conf):
+        """
+        Sets the scale the detectors run at. With an expected face size the scale is chosen so that such a face is
+        just above the smallest face the detector finds. For dlib, faces smaller than that are upsampled instead,
+        one pyramid level doubling the size
+        :param scale_conf: conf.json "detection_scale" section
+        :return: None
+        """
+        expected = scale_conf["expected_face_size"]
+        if expected > 0:
+            self.dlib_scale = 1.2 * self.DLIB_MIN_FACE / float(expected)
+            self.dlib_upsample = 0
+            while self.dlib_scale > 1:
+                self.dlib_scale /= 2
+                self.dlib_upsample += 1
+            self.cascade_scale = min(1.0, 1.2 * self.CASCADE_MIN_FACE / float(expected))
+        else:
+            self.dlib_scale = scale_conf["dlib"]
+            self.dlib_upsample = scale_conf["dlib_upsample"]
+            self.cascade_scale = scale_conf["cascade"]
+
+    @staticmethod
+    def shrink_gray(frame, scale):
+        """
+        :param frame: image to shrink
+        :param scale: factor to scale the image by
+        :return: grayscale copy of the image scaled by scale
+        """
+        gray = frame if len(frame.shape) == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        size = (max(1, int(round(gray.shape[1] * scale))), max(1, int(round(gray.shape[0] * scale))))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def scale_boxes(boxes, scale):
+        """
+        Maps boxes found in an image scaled by scale back to the original image
+        :param boxes: bounding boxes (x, y, w, h) in the scaled image
+        :param scale: factor the image was scaled by
+        :return: list of bounding boxes (x, y, w, h) in the original image
+        """
+        if scale == 1:
+            return boxes
+        return [tuple(int(round(v / scale)) for v in box) for box in boxes]
+
     def find_faces_haar(self, frame):
         """
-        Returns bounding box of faces found using this instances haar-cascade
+        Returns bounding box of faces found using this instances haar-cascade,
+        on a grayscale copy scaled by the cascade detection scale
         This operation's execution speed has key "haar_detection" or "lbp_detection" depending on the algorithm
         :param frame: image to analyze
         :return: List of bounding box tuples (x, y, w, h)
         """
         start = time.time()
+        scale = self.cascade_scale
+        image = frame if scale == 1 else self.shrink_gray(frame, scale)
+        min_size = int(self.min_face_size * scale)
         faces = self.face_cascade.detectMultiScale(
-            frame,
+            image,
             scaleFactor=1.1,
             minNeighbors=5,
-            minSize=(30, 30),
+            minSize=(min_size, min_size),
             flags=cv2.cv.CV_HAAR_SCALE_IMAGE
         )
         self.performance_stats["Detection"].append(time.time() - start)
-        return faces
+        return faces if scale == 1 else np.array(self.scale_boxes(faces, scale))
 
     def find_faces_dlib(self, frame):
         """
-        Finds bounding box for faces using dlibs frontal face detector
+        Finds bounding box for faces using dlibs frontal face detector, at full size or on a grayscale copy
+        scaled by the dlib detection scale
         This operations execution speed has key "dlib_detection"
         :param frame: image to analyze
         :return: List of bounding box tuples in the form (x, y, w, h)
         """
         start = time.time()
-        faces = face_recognition.face_locations(frame)
+        scale = self.dlib_scale
+        image = frame if scale == 1 else self.shrink_gray(frame, scale)
+        faces = face_recognition.face_locations(image, self.dlib_upsample)
         self.performance_stats["Detection"].append(time.time() - start)
         opencv_faces = [utility.convert_dlib_location_to_opencv(x) for x in faces]
-        return opencv_faces
+        return self.scale_boxes(opencv_faces, scale)
+
+    def find_faces_two_stage(self, frame):
+        """
+        Proposes faces with the LBP cascade on a copy downscaled by proposal_scale, tuned for recall, and confirms
+        them with dlib's frontal face detector on padded crops around the proposals. Dlib only searches a small part
+        of the frame, while the false positives of the cascade are rejected.
+        This operation's execution speed has key "Detection"
+        :param frame: image to analyze
+        :return: List of bounding box tuples (x, y, w, h)
+        """
+        start = time.time()
+        scale = self.proposal_scale
+        # at least one pixel on each side, also for narrow motion regions and prior windows
+        small = cv2.resize(frame, (max(1, int(frame.shape[1] * scale)), max(1, int(frame.shape[0] * scale))),
+                           interpolation=cv2.INTER_AREA)
+        min_size = int(self.min_face_size * scale)
+        proposals = self.face_cascade.detectMultiScale(
+            small,
+            scaleFactor=1.1,
+            minNeighbors=self.proposal_neighbours,
+            minSize=(min_size, min_size),
+            flags=cv2.cv.CV_HAAR_SCALE_IMAGE
+        )
+        # overlapping proposals of the same face are confirmed once
+        crops = utility.merge_boxes([utility.pad_box([int(v / scale) for v in proposal], self.confirm_padding,
+                                                     frame.shape) for proposal in proposals])
+        faces = []
+        for x, y, w, h in crops:
+            confirmed = face_recognition.face_locations(frame[y:y + h, x:x + w], self.confirm_upsample)
+            faces.extend((x + x1, y + y1, w1, h1)
+                         for x1, y1, w1, h1 in map(utility.convert_dlib_location_to_opencv, confirmed))
+        self.cascade_stats["Proposals"] += len(proposals)
+        self.cascade_stats["Confirmations"] += len(crops)
+        self.cascade_stats["Confirmed"] += len(faces)
+        self.performance_stats["Detection"].append(time.time() - start)
+        return faces
+
+    def analyze_motion(self, frame):
+        """
+        Updates the background model with the frame and finds its motion regions, once per frame context.
+        Called for every frame when motion analysis runs more often than face detection, which then reuses the regions
+        :param frame: image to analyze, or its FrameContext
+        :return: A list of tuples in the form (cropped_image, original_bounding box), see get_potential_regions
+        """
+        context = frame_context.get_context(frame)
+        if context is not self.motion_context:
+            self.motion_areas = self.get_potential_regions(context)
+            self.motion_context = context
+            if len(self.motion_areas) == 0 and self.is_dynamic:
+                self.accumulate_background()
+        return self.motion_areas
 
     def get_bounding_box(self, frame):
         """
         returns the bounding box (opencv format) of potential face regions
-        :param frame: image to analyze for faces
+        :param frame: image to analyze for faces, or its FrameContext
         :return: List of bounding boxes in (x, y, w, h)
         """
         start_time = time.time()
-        potential_areas = self.get_potential_regions(frame)
+        potential_areas = self.analyze_motion(frame)
         bounding_boxes = []
 
-        if len(potential_areas) == 0 and self.is_dynamic:
-            self.accumulate_background()
-
         for area, bounding_box in potential_areas:
             faces = self.face_detection_method(area)
 
@@ -175,35 +438,101 @@ class BackgroundExtractor:
             bounding_boxes.extend(self.get_face_bounds(faces, bounding_box))
         if len(bounding_boxes) > 0:
             self.performance_stats["Total_detection_time"].append(time.time() - start_time)
+        self.last_faces = bounding_boxes
         return bounding_boxes
 
     def detect_face(self, frame):
         """
-        Detects faces in the given image using the parameters given during class initialization
-        :param frame: image to search for faces in
+        Detects faces in the given image using the parameters given during class initialization.
+        While faces are known from the previous frame, only windows around them are searched, see search_priors.
+        The whole frame is scanned when that fails, and at least every full_scan_interval seconds to find newcomers
+        :param frame: image to search for faces in, or its FrameContext
         :return: list of face locations in dlib-format
         """
-        return self.get_bounding_box(frame) if self.do_bg_subtraction else self.detect_face_basic(frame)
+        context = frame_context.get_context(frame)
+        now = time.time()
+        missed = False
+        if self.prior_search and len(self.priors) > 0 and now - self.last_full_scan < self.full_scan_interval:
+            faces = self.search_priors(context)
+            if faces is not None:
+                return faces
+            missed = True
+        self.last_full_scan = now
+        self.prior_stats["Full_scans"] += 1
+        faces = self.get_bounding_box(context) if self.do_bg_subtraction else self.detect_face_basic(context)
+        if self.prior_search and self.do_bg_subtraction and len(self.motion_areas) == 0 and len(self.priors) > 0:
+            # a user sitting still causes no motion, so the scan cannot find them. Look where they were instead,
+            # unless that search just missed on this very frame
+            faces = None if missed else self.search_priors(context)
+            if faces is None:
+                self.priors = []
+                return []
+            return faces
+        self.priors = list(faces)
+        return faces
+
+    def reset_priors(self):
+        """
+        Forgets the faces of the previous frame, e.g. after the processing resolution changed
+        :return: None
+        """
+        self.priors = []
+        self.last_full_scan = 0
+
+    def search_priors(self, frame):
+        """
+        Searches for each face of the previous frame in a window around its last location, grown on every side by
+        the fractions of prior_expansions in turn until the face is found
+        :param frame: image to search for faces in, or its FrameContext
+        :return: list of face locations in dlib-format, or None if a face was not found in its widest window
+        """
+        start_time = time.time()
+        image = self.get_detection_image(frame_context.get_context(frame))
+        faces = []
+        for prior in self.priors:
+            for expansion in self.prior_expansions:
+                window = utility.pad_box(utility.convert_dlib_location_to_opencv(prior), expansion, image.shape)
+                if window[2] == 0 or window[3] == 0:
+                    # the prior lies outside the frame
+                    continue
+                crop = frame_context.FrameContext.crop(image, window)
+                found = self.get_face_bounds(self.face_detection_method(crop), window)
+                if len(found) > 0:
+                    break
+            else:
+                self.prior_stats["Misses"] += 1
+                return None
+            if len(faces) > 0:
+                # a wide window may contain a face found around another prior already
+                found = [face for face, overlap in
+                         zip(found, face_tracker.FaceTracker.get_iou_matrix(found, faces).max(axis=1)) if overlap < 0.5]
+            faces.extend(found)
+        self.prior_stats["Hits"] += 1
+        self.performance_stats["Total_detection_time"].append(time.time() - start_time)
+        self.priors = self.last_faces = faces
+        return faces
 
     def detect_face_basic(self, frame):
         """
         Detects the face without doing background substitution
-        :param frame: image in which to search for a face
+        :param frame: image in which to search for a face, or its FrameContext
         :return: A list of face locations in dlib-format
         """
         time_s = time.time()
-        faces = utility.convert_opencv_location_to_dlib(self.face_detection_method(frame))
+        image = self.get_detection_image(frame_context.get_context(frame))
+        faces = utility.convert_opencv_location_to_dlib(self.face_detection_method(image))
         self.performance_stats["Total_detection_time"].append(time.time() - time_s)
         return faces
 
     def accumulate_background(self):
         """
         If self.negative_seconds_limit has passed since previous positive face detection
-        accumulate the background
+        accumulate the background. The mixture model learns from every frame instead, except around the last faces
         :return: None
         """
-        if time.time()-self.previous_positive_detection > self.negative_seconds_limit:
+        if self.mixture is None and time.time()-self.previous_positive_detection > self.negative_seconds_limit:
             cv2.accumulateWeighted(self.current_frame, self.avg, 0.01)
+            cv2.convertScaleAbs(self.avg, self.avg_8u)
 
     def get_face_bounds(self, faces, bounding_box):
         """
@@ -226,54 +555,274 @@ class BackgroundExtractor:
         return bounding_boxes
 
 
-'''
-if __name__ == "__main__":
-    conf = json.load(open('conf.json'))
-    path_to_file = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
-
-    video_capture = VideoStream(usePiCamera=conf["use_rpi_camera"] > 0).start()
-    time.sleep(2.0)
-
-    bgsub = BackgroundExtractor(video_capture.read(), conf, path_to_file)
-    face_cascade = cv2.CascadeClassifier('cascades/lbpcascade_frontalface.xml')
-    debug=True
-    try:
-        while True:
-            frame = video_capture.read()
-            frame = imutils.resize(frame, width=500)
-
-            #potentialAreas = bgsub.getPotentialRegions(frame)
+class MixtureBackgroundModel:
+    """
+    Per-pixel mixture of Gaussians over the blurred grayscale intensity, vectorized with NumPy and run at a fraction
+    of the processing resolution. Each pixel keeps a few modes. The heaviest and narrowest modes, which together hold
+    background_weight of the weight, are background, so flicker and lighting that alternates between a few levels
+    become background modes instead of motion. Every frame is scaled by a global gain, the median ratio of the
+    background to the frame, which cancels sudden changes of the overall lighting
+    """
 
-            #face_locations = bgsub.getBoundingBox(frame)
-
-            regions = bgsub.getBoundingBox(frame)
-            for x,y,w,h in regions:
-                cv2.rectangle(frame, (h, x), (y, w), (100, 0, 100), 2)
-
-            print "negative frames count: " + str(time.time()-bgsub.previous_positive_detection)
+    def __init__(self, first_gray, conf):
+        """
+        :param first_gray: blurred grayscale frame the background is initialized with
+        :param conf: configuration file, its "background_model" section configures the mixture
+        """
+        model_conf = conf["background_model"]
+        self.scale = model_conf["scale"]
+        self.num_modes = model_conf["modes"]
+        self.learning_rate = model_conf["learning_rate"]
+        self.match_threshold = model_conf["match_threshold"]
+        self.initial_variance = model_conf["initial_variance"]
+        self.min_variance = model_conf["min_variance"]
+        self.background_weight = model_conf["background_weight"]
+        self.compensate_illumination = model_conf["illumination_compensation"]
+        self.freeze_padding = model_conf["freeze_padding"]
+
+        small = self.shrink(first_gray)
+        self.means = np.zeros((self.num_modes,) + small.shape, dtype=np.float32)
+        self.variances = np.full((self.num_modes,) + small.shape, self.initial_variance, dtype=np.float32)
+        self.weights = np.zeros((self.num_modes,) + small.shape, dtype=np.float32)
+        self.means[0] = small
+        self.weights[0] = 1
+        self.gain = 1.0
+        self.set_grid(small.shape)
+
+    def set_grid(self, shape):
+        self.rows, self.columns = np.ogrid[:shape[0], :shape[1]]
+        self.modes = np.arange(self.num_modes, dtype=np.intp)[:, None, None]
+
+    def shrink(self, gray):
+        height = max(1, int(round(gray.shape[0] * self.scale)))
+        width = max(1, int(round(gray.shape[1] * self.scale)))
+        return cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def resize(self, shape):
+        """
+        Scales the model to a new processing resolution
+        :param shape: shape of the reduced resolution frames
+        :return: None
+        """
+        size = (shape[1], shape[0])
+        self.means, self.variances, self.weights = [
+            np.array([cv2.resize(plane, size, interpolation=cv2.INTER_NEAREST) for plane in planes])
+            for planes in (self.means, self.variances, self.weights)]
+        self.set_grid(shape)
 
-            if conf["show_video"]["detection"]:
-                cv2.imshow('Face detection', frame)
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
+    def get_background(self):
+        """
+        :return: mean of the heaviest mode of every pixel, at the reduced resolution
+        """
+        return self.means[self.weights.argmax(axis=0), self.rows, self.columns]
 
+    def get_foreground(self, gray, frozen_boxes=(), learn=True, dst=None):
+        """
+        Classifies the pixels of the frame and updates the mixture with it
+        :param gray: blurred grayscale frame at processing resolution
+        :param frozen_boxes: face locations (top, right, bottom, left) where the model does not learn, so a user
+                standing still is not absorbed into the background
+        :param learn: False to only classify
+        :param dst: optional 8-bit image of the frame's size to write the mask to
+        :return: foreground mask at processing resolution, 255 for foreground
+        """
+        frame = self.shrink(gray)
+        if frame.shape != self.means.shape[1:]:
+            self.resize(frame.shape)
+        if self.compensate_illumination:
+            self.gain = float(np.clip(np.median(self.get_background() / np.maximum(frame, 1)), 0.25, 4))
+            frame *= self.gain
+
+        difference = frame - self.means
+        distances = difference ** 2 / self.variances
+        matches = (distances < self.match_threshold ** 2) & (self.weights > 0)
+        matched = matches.any(axis=0)
+        best = np.where(matches, distances, np.inf).argmin(axis=0)
+
+        # the matched mode is background if the modes ranked above it by weight / sigma hold less than
+        # background_weight, only the matched mode is ranked, so the modes need not be sorted
+        fitness = self.weights / np.sqrt(self.variances)
+        best_fitness = fitness[best, self.rows, self.columns]
+        weight_above = (self.weights * (fitness > best_fitness)).sum(axis=0)
+        foreground = ~matched | (weight_above >= self.background_weight)
+
+        if learn:
+            self.learn(frame, difference, best, matched, frozen_boxes, gray.shape)
+
+        mask = foreground.astype(np.uint8) * 255
+        return cv2.resize(mask, (gray.shape[1], gray.shape[0]), dst=dst, interpolation=cv2.INTER_NEAREST)
+
+    def learn(self, frame, difference, best, matched, frozen_boxes, full_shape):
+        learnable = np.ones(frame.shape, dtype=bool)
+        scale_y, scale_x = frame.shape[0] / float(full_shape[0]), frame.shape[1] / float(full_shape[1])
+        for top, right, bottom, left in frozen_boxes:
+            pad_x, pad_y = (right - left) * self.freeze_padding, (bottom - top) * self.freeze_padding
+            learnable[max(0, int((top - pad_y) * scale_y)):int((bottom + pad_y) * scale_y) + 1,
+                      max(0, int((left - pad_x) * scale_x)):int((right + pad_x) * scale_x) + 1] = False
+
+        rate = self.learning_rate
+        owner = (self.modes == best) & matched & learnable
+        self.weights *= np.where(learnable, np.float32(1 - rate), np.float32(1))
+        self.weights += rate * owner
+        # the matched mode moves towards the pixel, faster while it is still light
+        step = np.minimum(rate / np.maximum(self.weights, rate), 1) * owner
+        self.means += step * difference
+        self.variances += step * (difference ** 2 - self.variances)
+        np.maximum(self.variances, self.min_variance, out=self.variances)
+
+        # pixels no mode explains replace their weakest mode
+        replace = ~matched & learnable
+        if replace.any():
+            weakest = self.weights.argmin(axis=0)[replace]
+            rows, columns = np.nonzero(replace)
+            self.means[weakest, rows, columns] = frame[replace]
+            self.variances[weakest, rows, columns] = self.initial_variance
+            self.weights[weakest, rows, columns] = rate
+        self.weights /= self.weights.sum(axis=0)
+
+
+def benchmark(image_folder, conf, path_to_file, repetitions):
+    """
+    Times background subtraction with background accumulation on the images of image_folder, shown in turn as video.
+    Minor page faults per frame are counted as well, they grow with the number of frame-sized buffers allocated.
+    Run with MALLOC_MMAP_THRESHOLD_=65536 in the environment, otherwise glibc recycles freed buffers without faults
+    :param image_folder: folder of images
+    :param conf: configuration file
+    :param path_to_file: directory of working directory
+    :param repetitions: number of frames to time
+    :return: None
+    """
+    import resource
+    width = conf["frame_width"]
+    frames = [cv2.resize(cv2.imread(os.path.join(image_folder, image)), (width, width * 3 // 4))
+              for image in utility.get_sorted_directory(image_folder)
+              if image.lower().endswith((".jpg", ".jpeg", ".png"))]
+    conf = copy.deepcopy(conf)
+    conf["headless"] = True
+    model = BackgroundExtractor(frames[0], conf, path_to_file)
+    for i in range(10):
+        model.get_potential_regions(frames[i % len(frames)])
+        model.accumulate_background()
+
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.time()
+    for i in range(repetitions):
+        model.get_potential_regions(frames[i % len(frames)])
+        model.accumulate_background()
+    elapsed = time.time() - start
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+    print "{0}x{1}: {2:.3f} ms per frame, {3:.1f} minor page faults per frame".format(
+        width, width * 3 // 4, elapsed / repetitions * 1000, faults / float(repetitions))
+
+
+def benchmark_detection(image_folders, conf, path_to_file, scales, upsample):
+    """
+    Times the face detector of conf["detection_algorithm"] at several detection scales. Recall is the fraction of the
+    faces found at full size that are found again, with an intersection over union of at least 0.5
+    :param image_folders: folders of images with faces
+    :param conf: configuration file
+    :param path_to_file: directory of working directory
+    :param scales: detection scales to compare
+    :param upsample: number of times dlib upsamples the image
+    :return: None
+    """
+    import face_tracker
+    width = conf["frame_width"]
+    frames = []
+    for image_folder in image_folders:
+        for image in utility.get_sorted_directory(image_folder):
+            frame = cv2.imread(os.path.join(image_folder, image))
+            if frame is not None:
+                frames.append(cv2.resize(frame, (width, frame.shape[0] * width // frame.shape[1]),
+                                         interpolation=cv2.INTER_AREA))
+    model = BackgroundExtractor(frames[0], conf, path_to_file)
+    model.dlib_upsample = upsample
+
+    reference = None
+    print "{0} on {1} images, width {2}, upsample {3}".format(
+        BackgroundExtractor.get_algorithm_text(conf["detection_algorithm"]), len(frames), width, upsample)
+    for scale in [1.0] + [scale for scale in scales if scale != 1.0]:
+        model.dlib_scale = model.cascade_scale = scale
+        start = time.time()
+        faces = [utility.convert_opencv_location_to_dlib(model.face_detection_method(frame)) for frame in frames]
+        elapsed = (time.time() - start) / len(frames)
+        if reference is None:
+            reference = faces
+        found = sum(int((face_tracker.FaceTracker.get_iou_matrix(expected, detected) >= 0.5).any(axis=1).sum())
+                    for expected, detected in zip(reference, faces) if len(expected) > 0 and len(detected) > 0)
+        total = sum(len(expected) for expected in reference)
+        print "scale {0:.2f}: {1:.1f} ms per frame, recall {2}/{3}".format(scale, elapsed * 1000, found, total)
+
+
+def benchmark_algorithms(image_folders, conf, path_to_file, algorithms, face_width):
+    """
+    Times the face detection algorithms on the same frames and reports their precision and recall. Every image is
+    scaled to face_width pixels and pasted at a random position of a textured frame, so the location of its face is
+    known. A detection is correct if its center lies inside the pasted image
+    :param image_folders: folders of images with one face each
+    :param conf: configuration file, the detection settings of every algorithm are taken from it
+    :param path_to_file: directory of working directory
+    :param algorithms: detection algorithms to compare, see BackgroundExtractor.load_face_detection_algorithm
+    :param face_width: width in pixels of the pasted images
+    :return: None
+    """
+    width = conf["frame_width"]
+    height = width * 3 // 4
+    rng = np.random.RandomState(0)
+    frames = []
+    for image_folder in image_folders:
+        for image in utility.get_sorted_directory(image_folder):
+            face = cv2.imread(os.path.join(image_folder, image))
+            if face is None:
+                continue
+            face = cv2.resize(face, (face_width, face.shape[0] * face_width // face.shape[1]),
+                              interpolation=cv2.INTER_AREA)
+            frame = cv2.GaussianBlur(rng.randint(0, 256, (height, width, 3)).astype(np.uint8), (0, 0), 3)
+            x, y = rng.randint(0, width - face.shape[1] + 1), rng.randint(0, height - face.shape[0] + 1)
+            frame[y:y + face.shape[0], x:x + face.shape[1]] = face
+            frames.append((frame, (x, y, face.shape[1], face.shape[0])))
+
+    print "{0} frames of {1}x{2}, faces pasted at {3} pixels".format(len(frames), width, height, face_width)
+    print "{0:<24} {1:>10} {2:>11} {3:>10} {4:>8}".format("algorithm", "ms/frame", "detections", "precision",
+                                                          "recall")
+    for algorithm in algorithms:
+        algorithm_conf = copy.deepcopy(conf)
+        algorithm_conf["detection_algorithm"] = algorithm
+        model = BackgroundExtractor(frames[0][0], algorithm_conf, path_to_file)
+        detections = correct = found = 0
+        start = time.time()
+        results = [model.face_detection_method(frame) for frame, _ in frames]
+        elapsed = (time.time() - start) / len(frames)
+        for faces, (x, y, w, h) in zip(results, [box for _, box in frames]):
+            hits = sum(1 for x1, y1, w1, h1 in faces if x <= x1 + w1 / 2 < x + w and y <= y1 + h1 / 2 < y + h)
+            detections += len(faces)
+            correct += hits
+            found += int(hits > 0)
+        print "{0:<24} {1:>10.1f} {2:>11} {3:>10.3f} {4:>8.3f}".format(
+            BackgroundExtractor.get_algorithm_text(algorithm), elapsed * 1000, detections,
+            correct / float(max(1, detections)), found / float(len(frames)))
 
-                    # all_faces = []
-                    # for area, bounding_box in potentialAreas:
-                    #     faces = face_cascade.detectMultiScale(
-                    #         area,
-                    #         scaleFactor=1.1,
-                    #         minNeighbors=5,
-                    #         minSize=(30, 30),
-                    #         flags=cv2.cv.CV_HAAR_SCALE_IMAGE
-                    #     )
-                    #     if conf["show_video"]["detection"]:
-                    #         for face in faces:
-                    #             (x1, y1, w1, h1) = face
-                    #             x, y, w, h = bounding_box
-                    #             cv2.rectangle(frame, (x+x1, y+y1), (x+x1 + w1, y+y1 + h1), (0, 255, 0), 2)
-                    #             cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 255, 0), 2)
-    except KeyboardInterrupt:
-        pass
-'''
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the background subtraction and face detection")
+    subparsers = parser.add_subparsers(dest="command")
+    background_parser = subparsers.add_parser("background", help="background subtraction time and allocations")
+    background_parser.add_argument("--images", default="images/001_ingunn")
+    background_parser.add_argument("--repetitions", type=int, default=500)
+    detection_parser = subparsers.add_parser("detection", help="face detection time and recall per detection scale")
+    detection_parser.add_argument("--images", nargs="+", default=["images/001_ingunn", "images/002_jarle"])
+    detection_parser.add_argument("--scales", type=float, nargs="+", default=[1.0, 0.75, 0.5, 0.35, 0.25])
+    detection_parser.add_argument("--upsample", type=int, default=0)
+    detection_parser.add_argument("--algorithms", type=int, nargs="+",
+                                  help="compare these detection algorithms instead of the detection scales")
+    detection_parser.add_argument("--face-width", type=int, default=150,
+                                  help="width of the faces pasted into the frames when comparing algorithms")
+    args = parser.parse_args()
+    path_to_file = os.path.dirname(os.path.abspath(__file__))
+    conf = json.load(open(os.path.join(path_to_file, "conf.json")))
+    if args.command == "background":
+        benchmark(args.images, conf, path_to_file, args.repetitions)
+    elif args.algorithms:
+        benchmark_algorithms(args.images, conf, path_to_file, args.algorithms, args.face_width)
+    else:
+        benchmark_detection(args.images, conf, path_to_file, args.scales, args.upsample)
@@ -0,0 +1,84 @@
+import argparse
+import os
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+import utility
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def create_handler(images, delay):
+    """
+    :param images: list of JPEG images as strings, served in turn
+    :param delay: seconds to wait before answering, simulating the camera and network
+    :return: request handler class serving the images
+    """
+    counter = {"next": 0}
+    lock = threading.Lock()
+
+    class SnapshotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        # HTTP/1.1 keeps the connection open between requests
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, which Nagle's algorithm would delay on a kept-alive connection
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            with lock:
+                image = images[counter["next"] % len(images)]
+                counter["next"] += 1
+            if delay > 0:
+                time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SnapshotHandler
+
+
+def load_images(image_folder):
+    images = []
+    for image in utility.get_sorted_directory(image_folder):
+        if image.lower().endswith((".jpg", ".jpeg")):
+            with open(os.path.join(image_folder, image), "rb") as image_file:
+                images.append(image_file.read())
+    return images
+
+
+def start_server(image_folder, port=2067, delay=0.0):
+    """
+    Starts a stand-in for RPi-Cam-Web-Interface that serves the JPEGs of image_folder in turn on any path,
+    e.g. http://localhost:2067/html/cam_pic_new.php
+    :param image_folder: folder of JPEG images
+    :param port: port to listen on, 0 picks a free port
+    :param delay: seconds to wait before answering each request
+    :return: running server, its port is server.server_address[1]
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), create_handler(load_images(image_folder), delay))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve JPEGs like the RPi-Cam-Web-Interface snapshot endpoint")
+    parser.add_argument("--images", default="images/001_ingunn")
+    parser.add_argument("--port", type=int, default=2067)
+    parser.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+    camera_server = start_server(args.images, args.port, args.delay)
+    print "Serving {0} on port {1}".format(args.images, camera_server.server_address[1])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        camera_server.shutdown()
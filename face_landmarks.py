@@ -4,6 +4,7 @@ import math
 import imutils
 import time
 import face_recognition as fr
+import frame_context
 import wink_queue as wq
 
 class WinkClassifier:
@@ -128,7 +129,7 @@ class WinkClassifier:
 
     def get_facial_landmarks(self, face, location, debug=True):
         time_start = time.time()
-        face_image = self.crop_face(face, location)
+        face_image = self.crop_face(frame_context.get_context(face).get_rgb(), location)
         face_image, location = self.resize_face(face_image)
         landmarks = fr.face_landmarks(face_image, location)
 
@@ -0,0 +1,117 @@
+import math
+import cv2
+import numpy as np
+import face_recognition as fr
+import frame_context
+
+# user index of faces that were not encoded because of their low quality. They give no login vote
+LOW_QUALITY = -3
+
+
+class FaceQualityGate:
+    """
+    Scores detected faces before they are encoded, so blurred, tiny, cut off or turned away faces do not cost an
+    encoding and do not vote "Unknown". The checks run from the cheapest to the most expensive:
+        1. size: the box must be at least min_face_size pixels wide
+        2. cut off: detectors return square boxes, a box cut by the border of a motion region is not square
+        3. sharpness: variance of the Laplacian of the face scaled to sharpness_size pixels, relative to the variance
+           of the face itself so it does not depend on contrast and lighting. Low for motion and focus blur
+        4. pose: from the facial landmarks, yaw as the offset of the nose tip from the middle of the eyes
+           (0 frontal, 1 nose in front of an eye) and roll as the angle of the eye line in degrees
+    """
+
+    def __init__(self, conf):
+        """
+        :param conf: configuration file, its "quality_gate" section configures the gate
+        """
+        gate_conf = conf["quality_gate"]
+        self.min_face_size = gate_conf["min_face_size"]
+        self.min_aspect = gate_conf["min_aspect"]
+        self.min_sharpness = gate_conf["min_sharpness"]
+        self.sharpness_size = gate_conf["sharpness_size"]
+        self.max_yaw = gate_conf["max_yaw"]
+        self.max_roll = gate_conf["max_roll"]
+        self.stats = {"Checked": 0, "Too_small": 0, "Cut_off": 0, "Blurred": 0, "Off_angle": 0}
+
+    def get_sharpness(self, gray, location):
+        """
+        :param gray: grayscale frame
+        :param location: face location in dlib-format (top, right, bottom, left)
+        :return: variance of the Laplacian of the face in percent of the variance of the face, both at
+                sharpness_size pixels so it does not depend on the distance to the camera. Smaller faces are
+                measured at their own size, upscaling would blur them
+        """
+        top, right, bottom, left = location
+        face = gray[max(0, top):bottom, max(0, left):right]
+        size = min(self.sharpness_size, face.shape[1])
+        face = cv2.resize(face, (size, size), interpolation=cv2.INTER_AREA)
+        return 100 * cv2.Laplacian(face, cv2.CV_64F).var() / max(face.var(), 1)
+
+    @staticmethod
+    def get_pose(landmarks):
+        """
+        :param landmarks: facial landmarks of one face as returned by face_recognition.face_landmarks
+        :return: (yaw, roll). yaw from 0 (frontal) to 1 (nose tip in front of an eye), roll in degrees
+        """
+        left_eye = np.mean(landmarks["left_eye"], axis=0)
+        right_eye = np.mean(landmarks["right_eye"], axis=0)
+        nose_tip = np.asarray(landmarks["nose_tip"][len(landmarks["nose_tip"]) // 2], dtype=np.float64)
+        eye_line = right_eye - left_eye
+        position = np.dot(nose_tip - left_eye, eye_line) / max(np.dot(eye_line, eye_line), 1)
+        return abs(position - 0.5) * 2, abs(math.degrees(math.atan2(eye_line[1], eye_line[0])))
+
+    def check_box(self, gray, location):
+        """
+        :return: None if the face passes the checks that need no landmarks, else the name of the failed check
+        """
+        top, right, bottom, left = location
+        width, height = right - left, bottom - top
+        if width < self.min_face_size:
+            return "Too_small"
+        if min(width, height) < self.min_aspect * max(width, height):
+            return "Cut_off"
+        if self.get_sharpness(gray, location) < self.min_sharpness:
+            return "Blurred"
+        return None
+
+    def check(self, frame, face_locations):
+        """
+        :param frame: current frame, or its FrameContext
+        :param face_locations: list of dlib-format locations
+        :return: list, aligned with face_locations, of True for the faces worth encoding
+        """
+        context = frame_context.get_context(frame)
+        passed = [False] * len(face_locations)
+        candidates = []
+        for i, location in enumerate(face_locations):
+            self.stats["Checked"] += 1
+            failed = self.check_box(context.get_gray(), location)
+            if failed is None:
+                candidates.append(i)
+            else:
+                self.stats[failed] += 1
+        if len(candidates) > 0:
+            landmarks = fr.face_landmarks(context.get_rgb(), [face_locations[i] for i in candidates])
+            for i, face_landmarks in zip(candidates, landmarks):
+                yaw, roll = self.get_pose(face_landmarks)
+                if yaw > self.max_yaw or roll > self.max_roll:
+                    self.stats["Off_angle"] += 1
+                else:
+                    passed[i] = True
+        return passed
+
+    def get_stats(self):
+        skipped = sum(self.stats[key] for key in ("Too_small", "Cut_off", "Blurred", "Off_angle"))
+        stats = {"Quality_" + key.lower(): value for key, value in self.stats.items()}
+        stats["Encodings_avoided"] = skipped
+        return stats
+
+
+def create_quality_gate(conf):
+    """
+    :param conf: configuration file
+    :return: FaceQualityGate configured by conf["quality_gate"], or None if disabled
+    """
+    if not conf["quality_gate"]["enabled"]:
+        return None
+    return FaceQualityGate(conf)
@@ -0,0 +1,144 @@
+import time
+import numpy as np
+
+
+class Track:
+
+    def __init__(self, track_id, location):
+        """
+        :param track_id: unique id of the track
+        :param location: face location in dlib-format (top, right, bottom, left)
+        """
+        self.id = track_id
+        self.location = location
+        self.user = -1
+        # number of consecutive encodings that recognized self.user
+        self.agreeing = 0
+        self.confidence = 0.0
+        self.last_encoded = None
+        self.missed = 0
+
+
+class FaceTracker:
+    """
+    Associates detected faces across frames by the overlap (IoU) of their boxes, and remembers the identity
+    of each track, so a face only has to be encoded when it is new, its confidence has decayed or
+    refresh_interval seconds have passed since it was last encoded.
+    An identity is only confirmed, and reused, once confirm_encodings consecutive encodings of the track agree on it,
+    so a single misrecognition is not repeated on every following frame
+    """
+
+    def __init__(self, conf):
+        """
+        :param conf: the "tracking" section of the configuration file
+        """
+        self.min_iou = conf["min_iou"]
+        self.refresh_interval = conf["refresh_interval"]
+        self.min_confidence = conf["min_confidence"]
+        self.max_missed = conf["max_missed"]
+        self.confirm_encodings = conf["confirm_encodings"]
+
+        self.tracks = []
+        self.next_id = 0
+        self.stats = {"encoded": 0, "reused": 0}
+
+    @staticmethod
+    def get_iou_matrix(locations_a, locations_b):
+        """
+        :param locations_a: list of n dlib-format locations
+        :param locations_b: list of m dlib-format locations
+        :return: matrix of shape (n, m) with the intersection over union of every pair of boxes
+        """
+        a = np.asarray(locations_a, dtype=np.float32).reshape(-1, 4)[:, None, :]
+        b = np.asarray(locations_b, dtype=np.float32).reshape(-1, 4)[None, :, :]
+        heights = np.maximum(0, np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]))
+        widths = np.maximum(0, np.minimum(a[..., 1], b[..., 1]) - np.maximum(a[..., 3], b[..., 3]))
+        intersection = heights * widths
+        area_a = (a[..., 2] - a[..., 0]) * (a[..., 1] - a[..., 3])
+        area_b = (b[..., 2] - b[..., 0]) * (b[..., 1] - b[..., 3])
+        return intersection / np.maximum(area_a + area_b - intersection, 1)
+
+    def associate(self, face_locations):
+        """
+        Greedily pairs tracks and faces by descending IoU
+        :param face_locations: list of dlib-format locations in the current frame
+        :return: list, aligned with face_locations, of (track, iou) or None for faces without a track
+        """
+        matches = [None] * len(face_locations)
+        if len(self.tracks) == 0 or len(face_locations) == 0:
+            return matches
+
+        iou = self.get_iou_matrix([t.location for t in self.tracks], face_locations)
+        used_tracks = set()
+        for flat in np.argsort(-iou, axis=None):
+            track_index, face_index = np.unravel_index(flat, iou.shape)
+            if iou[track_index, face_index] < self.min_iou:
+                break
+            if track_index in used_tracks or matches[face_index] is not None:
+                continue
+            used_tracks.add(track_index)
+            matches[face_index] = (self.tracks[track_index], float(iou[track_index, face_index]))
+        return matches
+
+    def update(self, face_locations, now=None):
+        """
+        Updates the tracks with the faces of the current frame
+        :param face_locations: list of dlib-format locations in the current frame
+        :param now: timestamp of the frame, defaults to the current time
+        :return: (tracks, stale). tracks is aligned with face_locations, stale lists the face_locations indexes
+                that have to be encoded
+        """
+        now = time.time() if now is None else now
+        matches = self.associate(face_locations)
+
+        tracks = []
+        stale = []
+        for i, location in enumerate(face_locations):
+            if matches[i] is None:
+                track = Track(self.next_id, location)
+                self.next_id += 1
+                self.tracks.append(track)
+            else:
+                track, iou = matches[i]
+                track.location = location
+                track.confidence *= iou
+                track.missed = 0
+            tracks.append(track)
+
+            if track.last_encoded is None or track.confidence < self.min_confidence \
+                    or now - track.last_encoded > self.refresh_interval:
+                stale.append(i)
+                self.stats["encoded"] += 1
+            else:
+                self.stats["reused"] += 1
+
+        seen = set(id(track) for track in tracks)
+        for track in self.tracks:
+            if id(track) not in seen:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+        return tracks, stale
+
+    def set_identities(self, tracks, users, now=None):
+        """
+        Stores the recognized users of freshly encoded tracks. Unknown faces and identities not yet confirmed by
+        confirm_encodings agreeing encodings get no confidence, so they are encoded again on the next frame
+        :param tracks: tracks that were encoded
+        :param users: recognized user index of each track
+        :param now: timestamp of the frame, defaults to the current time
+        :return: None
+        """
+        now = time.time() if now is None else now
+        for track, user in zip(tracks, users):
+            if user <= 0:
+                track.agreeing = 0
+            elif user == track.user:
+                track.agreeing += 1
+            else:
+                track.agreeing = 1
+            track.user = user
+            track.confidence = 1.0 if track.agreeing >= self.confirm_encodings else 0.0
+            track.last_encoded = now
+
+    def reset(self):
+        self.tracks = []
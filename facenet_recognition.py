@@ -3,43 +3,127 @@ import os
 import inspect
 import time
 import utility
+import frame_context
+import face_quality
+import gallery_cache
+import gallery_matcher
+import ann_index
+import gallery_watcher
 
 
 class FacenetRecognizer:
 
     def __init__(self, image_folder, conf):
+        self.image_folder = image_folder
         self.number_of_faces = conf["num_faces"]
-
-        self.known_face_encodings, self.known_face_names = self.initialize_face_encoding(image_folder)
+        self.enrollment_workers = conf["enrollment_workers"]
+        self.enrollment_chunk_size = conf["enrollment_chunk_size"]
+        self.match_tolerance = conf["match_tolerance"]
+        self.matching_method = conf["matching_method"]
+        self.ann_conf = conf["ann_index"]
+        self.quality_gate = face_quality.create_quality_gate(conf)
         self.this_script_path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        self.cache = gallery_cache.GalleryCache(os.path.join(self.this_script_path, conf["gallery_cache_path"]),
+                                                image_folder)
+
+        self.known_face_encodings = []
+        self.known_face_names = []
+        self.known_face_users = []
+        # user index -> name of the user folder, of the loaded gallery
+        self.user_folders = None
+        self.matcher = None
+        # functions called after every reload, e.g. to make worker processes reload too
+        self.reload_listeners = []
+        # functions called when a reload gave a known user index to another folder or removed it
+        self.users_changed_listeners = []
+        self.reload_gallery()
+
+        self.watcher = None
+        if conf["gallery_poll_interval"] > 0:
+            self.watcher = gallery_watcher.GalleryWatcher(image_folder, conf["gallery_poll_interval"],
+                                                          self.reload_gallery)
+            self.watcher.start()
 
         self.performance_stats = {"Matching": [], "Facenet_encoding": []}
 
+    def reload_gallery(self):
+        """
+        Encodes the new or changed images of the gallery and swaps in a matcher for the updated gallery.
+        Recognition keeps using the previous matcher until the new one is complete.
+        The cache file is read again first, since another process may have encoded the new images already
+        :return: None
+        """
+        self.cache.load()
+        encodings, names, users = self.initialize_face_encoding(self.image_folder)
+        matcher = gallery_matcher.GalleryMatcher(encodings, users, tolerance=self.match_tolerance,
+                                                 method=self.matching_method)
+        if self.ann_conf["enabled"]:
+            matcher.neighbours = self.ann_conf["neighbours"]
+            matcher.index = ann_index.IVFIndex.load_or_build(
+                os.path.join(self.this_script_path, self.ann_conf["path"]), matcher.encodings,
+                self.ann_conf["num_cells"], self.ann_conf["num_probes"])
+
+        self.known_face_encodings, self.known_face_names, self.known_face_users = encodings, names, users
+        self.matcher = matcher
+        print "Gallery loaded: {0} encodings of {1} users".format(len(encodings), len(set(users)))
+
+        user_folders = dict(zip(users, names))
+        previous, self.user_folders = self.user_folders, user_folders
+        for listener in self.reload_listeners:
+            listener()
+        if previous is not None and any(user_folders.get(user) != name for user, name in previous.items()):
+            print "User indexes changed, votes are cleared and the current user is logged out"
+            for listener in self.users_changed_listeners:
+                listener()
+
     def get_average_stats(self):
         """
         Calculates the average of the accumulated statistics
         :return: Dictionary with the keys "Matching" and "Facenet_encoding" for the average
                 matching speed and encoding speed respectively
         """
-        return {"Matching": utility.list_avg(self.performance_stats["Matching"]),
-                "Facenet_encoding": utility.list_avg(self.performance_stats["Facenet_encoding"])}
+        stats = {"Matching": utility.list_avg(self.performance_stats["Matching"]),
+                 "Facenet_encoding": utility.list_avg(self.performance_stats["Facenet_encoding"])}
+        if self.quality_gate is not None:
+            stats.update(self.quality_gate.get_stats())
+        return stats
 
     def initialize_face_encoding(self, image_folder):
         """
         creates an encoding of length 128 using deepnet
+        Encodings are read from the gallery cache, only new or changed images are encoded, in parallel
+        Images that cannot be encoded, e.g. because no face is found, are reported and left out
+        Each user may have a different number of images, at most self.number_of_faces are used (0 = all)
         :param image_folder: folder of images to encode
-        :return: list of encodings
+        :return: list of encodings, list of names and list of user indexes (1-indexed) of each encoding.
+                The user index is the numeric prefix of the user folder, see utility.get_user_indexes
         """
-        images = []
+        image_paths = []
         names = []
-        for directory in utility.get_sorted_directory(image_folder):
+        users = []
+        directories = [d for d in utility.get_sorted_directory(image_folder)
+                       if os.path.isdir(os.path.join(image_folder, d))]
+        for user_index, directory in zip(utility.get_user_indexes(directories), directories):
             dir_path = os.path.join(image_folder, directory)
             name = os.path.splitext(dir_path)[0]
             person_images = utility.get_sorted_directory(dir_path)
-            for i in range(self.number_of_faces):
-                images.append(fr.load_image_file(os.path.join(dir_path, person_images[i])))
+            if self.number_of_faces > 0:
+                person_images = person_images[:self.number_of_faces]
+            for image in person_images:
+                image_paths.append(os.path.join(dir_path, image))
                 names.append(name)
-        return [fr.face_encodings(encoding)[0] for encoding in images], names
+                users.append(user_index)
+
+        encodings, failures = self.cache.get_encodings(image_paths, self.enrollment_workers,
+                                                       self.enrollment_chunk_size)
+        for image_path, error in failures:
+            print "Could not enroll {0}: {1}".format(image_path, error)
+        self.cache.prune(image_paths)
+        if self.cache.is_dirty:
+            self.cache.save()
+
+        enrolled = [i for i in range(len(encodings)) if encodings[i] is not None]
+        return [encodings[i] for i in enrolled], [names[i] for i in enrolled], [users[i] for i in enrolled]
 
     def initialize_face_names(self, image_folder):
         """
@@ -52,13 +136,14 @@ class FacenetRecognizer:
     def encode_face(self, frame, face_locations, debug=False):
         """
         creates encoding for the face(s) given by face_locations
-        :param frame: current frame
+        The gallery is encoded from RGB images, so the faces are encoded from the RGB view of the frame
+        :param frame: current frame, or its FrameContext
         :param face_locations: a list of (top, right, bottom, left)? tuples
         :param debug: whether execution time should be recorded
         :return: a list 128-length encodings of found faces
         """
         time_start = time.time()
-        face_encodings = fr.face_encodings(frame, face_locations)
+        face_encodings = fr.face_encodings(frame_context.get_context(frame).get_rgb(), face_locations)
 
         if debug:
             time_end = time.time()
@@ -66,62 +151,46 @@ class FacenetRecognizer:
 
         return face_encodings
 
-    def compare_face(self, new_encoding, debug=False):
+    def compare_face(self, new_encodings, debug=False):
         """
-        compares the given encoding with the set of known faces
-        :param new_encoding: encoding to be classified
+        compares the given encodings with the whole set of known faces in one distance computation
+        :param new_encodings: list of encodings to be classified
         :param debug: whether execution time should be recorded
-        :return: a boolean list of whether the given index face was found
+        :return: (labels, distances) arrays. labels are the user indexes (1-indexed), -1 if unknown
         """
         time_start = time.time()
-        match = fr.compare_faces(self.known_face_encodings, new_encoding)
+        labels, distances = self.matcher.match(new_encodings)
         if debug:
             time_end = time.time()
             self.performance_stats["Matching"].append(time_end - time_start)
 
-        return match
+        return labels, distances
 
-    def get_corresponding_user(self, match_list):
-        """
-        looks up the names corresponding to the given list of matches
-        :param match_list: a boolean list indicating the indexes of found faces
-        :return: a list of (name, index) tuples
-        """
-        names = []
-        for i in range(len(match_list)):
-            if match_list[i]:
-                names.append((self.known_face_names[i], i))
-        if len(names) == 0:
-            names.append(("Unknown", -1))
-        return names
-
-    def get_corresponding_index(self, match_list):
-        """
-        looks up the names corresponding to the given list of matches
-        :param match_list: a boolean list indicating the indexes of found faces
-        :return: a list of match_list indexes that were true (1-indexed)
+    def recognize_face_distances(self, frame, face_locations):
         """
-        indexes = [(i//self.number_of_faces)+1 for i in range(len(match_list)) if match_list[i]]
-
-        return [utility.most_common_element(indexes)] if len(indexes) > 0 else [-1]
+        checks whether there are known faces in the frame
+        Faces failing the quality gate are not encoded, they get the index face_quality.LOW_QUALITY and no distance
+        :param frame: current frame, or its FrameContext
+        :param face_locations: a list of (top, right, bottom, left)? tuples
+        :return: a list of user indexes and a list of the matching distances of the found faces
+        """
+        context = frame_context.get_context(frame)
+        if self.quality_gate is None:
+            passed = [True] * len(face_locations)
+        else:
+            passed = self.quality_gate.check(context, face_locations)
+        new_encodings = self.encode_face(context, [location for location, ok in zip(face_locations, passed) if ok])
+        labels, distances = self.compare_face(new_encodings)
+        labels, distances = iter(labels.tolist()), iter(distances.tolist())
+        results = [(next(labels), next(distances)) if ok else (face_quality.LOW_QUALITY, None) for ok in passed]
+        return [label for label, _ in results], [distance for _, distance in results]
 
     def recognize_face(self, frame, face_locations):
         """
         checks whether there is a known face in the frame
         :param frame: current frame
         :param face_locations: a list of (top, right, bottom, left)? tuples
-        :return: a list of (name, index) tuples for the found faces
+        :return: a list of user indexes (1-indexed) for the found faces, -1 for unknown faces,
+                face_quality.LOW_QUALITY for faces that were not encoded
         """
-        new_encodings = self.encode_face(frame, face_locations)
-        users = []
-        for new_encoding in new_encodings:
-            match_list = self.compare_face(new_encoding)
-            users.extend(self.get_corresponding_index(match_list))
-        return users
-
-
-
-
-
-
-
+        return self.recognize_face_distances(frame, face_locations)[0]
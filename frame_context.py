@@ -0,0 +1,94 @@
+import cv2
+
+
+class FrameContext:
+    """
+    One BGR frame and the views derived from it: grayscale, blurred grayscale and RGB.
+    Each view is computed the first time a stage asks for it and shared by the later stages of the same frame,
+    so detection, recognition and landmarks convert the frame at most once. Regions are cropped from the views,
+    which costs nothing
+    """
+
+    def __init__(self, frame):
+        """
+        :param frame: BGR image as read from the camera
+        """
+        self.frame = frame
+        self.views = {}
+        self.computed = 0
+        self.reused = 0
+
+    def get_view(self, name, compute):
+        """
+        :param name: name of the view
+        :param compute: function computing the view, called only if the view was not asked for before
+        :return: the view
+        """
+        view = self.views.get(name)
+        if view is None:
+            view = self.views[name] = compute()
+            self.computed += 1
+        else:
+            self.reused += 1
+        return view
+
+    def get_gray(self, dst=None):
+        """
+        :param dst: buffer to compute the view into, the view is then only valid until the buffer is reused
+        :return: grayscale view of the frame
+        """
+        return self.get_view("gray", lambda: cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY, dst=dst))
+
+    def get_blurred(self, dst=None):
+        """
+        :param dst: buffer to compute the view into, the view is then only valid until the buffer is reused
+        :return: grayscale view blurred by a 21x21 Gaussian, as used for background subtraction
+        """
+        return self.get_view("blurred", lambda: cv2.GaussianBlur(self.get_gray(), (21, 21), 0, dst=dst))
+
+    def get_rgb(self):
+        """
+        :return: RGB view of the frame, the channel order face_recognition and dlib expect
+        """
+        return self.get_view("rgb", lambda: cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB))
+
+    @staticmethod
+    def crop(view, box):
+        """
+        :param view: frame or one of its views
+        :param box: bounding box (x, y, w, h)
+        :return: region of the view inside the box, sharing its memory
+        """
+        x, y, w, h = box
+        return view[y:y + h, x:x + w]
+
+
+class ContextStats:
+    """
+    Accumulates how many views the frame contexts computed and how many requests they answered from a view
+    computed before, i.e. the conversions saved
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.computed = 0
+        self.reused = 0
+
+    def add(self, context):
+        self.frames += 1
+        self.computed += context.computed
+        self.reused += context.reused
+
+    def get_stats(self):
+        frames = float(max(1, self.frames))
+        return {"Conversions_per_frame": self.computed / frames,
+                "Conversions_saved_per_frame": self.reused / frames}
+
+
+def get_context(frame):
+    """
+    Lets the stages accept either a plain frame or the context of a frame
+    :param frame: BGR image or FrameContext
+    :return: FrameContext of the frame
+    """
+    return frame if isinstance(frame, FrameContext) else FrameContext(frame)
@@ -0,0 +1,439 @@
+import argparse
+import collections
+import httplib
+import threading
+import time
+import urlparse
+import zlib
+import cv2
+import numpy as np
+from imutils.video import VideoStream
+import utility
+
+
+def resize_to_width(frame, width):
+    """
+    Scales the frame to the processing width, keeping the aspect ratio. Frames already at that width,
+    e.g. decoded at reduced size, are returned as they are
+    :param frame: image to scale
+    :param width: processing width
+    :return: scaled image
+    """
+    if frame.shape[1] == width:
+        return frame
+    height = int(round(frame.shape[0] * width / float(frame.shape[1])))
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def get_thumbnail(frame, width):
+    """
+    :param frame: image to shrink
+    :param width: width of the thumbnail, its height keeps the aspect ratio
+    :return: grayscale thumbnail
+    """
+    height = max(1, frame.shape[0] * width // frame.shape[1])
+    thumbnail = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    if len(thumbnail.shape) == 3:
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+    return thumbnail
+
+
+class JPEGDecoder:
+    """
+    Decodes JPEGs straight to a reduced size with the libjpeg scaling of cv2.imdecode, choosing the largest
+    reduction (1/2, 1/4 or 1/8) that still gives at least the processing width. The remaining scaling to the
+    exact width is done on the much smaller decoded image.
+    The source width is learned from the first, fully decoded, image. OpenCV 2.4 lacks the reduced decode flags,
+    there every image is fully decoded
+    """
+    REDUCED_FLAGS = [(factor, getattr(cv2, "IMREAD_REDUCED_COLOR_{0}".format(factor), None)) for factor in (8, 4, 2)]
+
+    def __init__(self, width):
+        """
+        :param width: processing width
+        """
+        self.width = width
+        self.source_width = None
+
+    def get_flag(self):
+        """
+        :return: (reduction factor, imdecode flag) for the current source width
+        """
+        if self.source_width is not None:
+            for factor, flag in self.REDUCED_FLAGS:
+                if flag is not None and self.source_width // factor >= self.width:
+                    return factor, flag
+        return 1, cv2.IMREAD_COLOR
+
+    def decode(self, body):
+        """
+        :param body: compressed image
+        :return: image at the processing width, or None if the image could not be decoded
+        """
+        factor, flag = self.get_flag()
+        frame = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), flag)
+        if frame is None:
+            return None
+        source_width = frame.shape[1] * factor
+        if self.source_width is None or abs(source_width - self.source_width) >= factor:
+            # first image, or the camera resolution changed
+            self.source_width = source_width
+        return resize_to_width(frame, self.width)
+
+
+class DuplicateFrameFilter:
+    """
+    Detects frames that repeat the previous frame, so they can skip processing and reuse the previous results.
+    A frame is a duplicate if it is the same object as the previous frame, or if a small grayscale thumbnail of it
+    differs from the previous thumbnail by less than threshold on average
+    """
+
+    def __init__(self, threshold=1.0, thumbnail_width=16):
+        """
+        :param threshold: mean absolute difference (0-255) of the thumbnails below which frames are duplicates
+        :param thumbnail_width: width of the thumbnail, its height keeps the aspect ratio
+        """
+        self.threshold = threshold
+        self.thumbnail_width = thumbnail_width
+        self.last_frame = None
+        self.last_thumbnail = None
+        self.checked = 0
+        self.skipped = 0
+
+    def is_duplicate(self, frame):
+        """
+        :param frame: new frame
+        :return: True if the frame repeats the previous frame
+        """
+        self.checked += 1
+        if frame is self.last_frame:
+            self.skipped += 1
+            return True
+        thumbnail = get_thumbnail(frame, self.thumbnail_width)
+        if self.last_thumbnail is not None and cv2.absdiff(thumbnail, self.last_thumbnail).mean() < self.threshold:
+            self.skipped += 1
+            return True
+        self.last_frame = frame
+        self.last_thumbnail = thumbnail
+        return False
+
+    def get_stats(self):
+        return {"Frames_checked": self.checked, "Duplicates_skipped": self.skipped}
+
+
+class HTTPFrameSource:
+    """
+    Fetches frames from a single-JPEG snapshot endpoint, such as RPi-Cam-Web-Interface's cam_pic_new.php.
+    Each of in_flight threads keeps its own keep-alive connection and requests frames back to back,
+    so network jitter on one request does not stall the stream. read() always returns the newest frame,
+    read_next() waits for a newer one
+    """
+
+    def __init__(self, url, in_flight=2, timeout=2.0, width=None):
+        """
+        :param url: url of the snapshot endpoint
+        :param in_flight: number of concurrent requests, each on its own persistent connection
+        :param timeout: socket timeout in seconds
+        :param width: processing width frames are decoded to, None keeps the full resolution
+        """
+        parsed = urlparse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path + ("?" + parsed.query if parsed.query else "")
+        self.timeout = timeout
+        self.width = width
+
+        self.lock = threading.Lock()
+        # notified whenever a newer frame is stored
+        self.new_frame = threading.Condition(self.lock)
+        self.frame = None
+        self.body_checksum = None
+        self.timestamp = 0
+        self.request_time = 0
+        self.frame_id = 0
+
+        # set while fetching at full rate, cleared while throttled by set_rate
+        self.full_rate = threading.Event()
+        self.full_rate.set()
+        self.min_interval = 0
+
+        self.running = False
+        self.threads = [threading.Thread(target=self.fetch, name="Fetch-{0}".format(i)) for i in range(in_flight)]
+        for thread in self.threads:
+            thread.daemon = True
+
+        self.fetched = 0
+        self.outdated = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.request_latencies = collections.deque(maxlen=100)
+        self.start_time = time.time()
+
+    def start(self):
+        self.running = True
+        self.start_time = time.time()
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def set_rate(self, fps):
+        """
+        Throttles fetching, e.g. while nobody is in front of the mirror. Returning to full rate takes effect at once,
+        also for threads waiting to send their next request
+        :param fps: total number of frames to request per second, None for full rate
+        :return: None
+        """
+        if fps is None:
+            self.min_interval = 0
+            self.full_rate.set()
+        else:
+            self.min_interval = 1 / float(fps)
+            self.full_rate.clear()
+
+    def set_width(self, width):
+        """
+        :param width: new processing width frames are decoded to
+        :return: None
+        """
+        self.width = width
+
+    def request(self, connection):
+        """
+        Requests one frame over the persistent connection
+        :return: body of the response
+        """
+        connection.request("GET", self.path, headers={"Connection": "keep-alive"})
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise httplib.HTTPException("status {0}".format(response.status))
+        return body
+
+    def decode(self, body):
+        """
+        :param body: compressed image
+        :return: decoded frame or None if the image could not be decoded
+        """
+        return cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def fetch(self):
+        connection = None
+        # a decoder per thread, so each learns the source width without locking
+        decoder = JPEGDecoder(self.width) if self.width is not None else None
+        while self.running:
+            if self.min_interval > 0:
+                # each thread requests every in_flight intervals, together they request at the throttled rate
+                self.full_rate.wait(self.min_interval * len(self.threads))
+            if connection is None:
+                connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            request_time = time.time()
+            try:
+                body = self.request(connection)
+            except (httplib.HTTPException, IOError):
+                self.errors += 1
+                connection.close()
+                connection = None
+                time.sleep(0.1)
+                continue
+            arrival = time.time()
+            self.request_latencies.append(arrival - request_time)
+
+            # the snapshot often repeats when polled faster than the camera updates, skip decoding it again
+            checksum = zlib.adler32(body)
+            if checksum == self.body_checksum:
+                self.fetched += 1
+                self.duplicates += 1
+                continue
+            if decoder is not None:
+                decoder.width = self.width
+            frame = decoder.decode(body) if decoder is not None else self.decode(body)
+            if frame is None:
+                self.errors += 1
+                continue
+            self.store(frame, checksum, request_time, arrival)
+        if connection is not None:
+            connection.close()
+
+    def store(self, frame, checksum, request_time, arrival):
+        """
+        Keeps the frame if it was requested after the current frame, responses overtaken by a newer request
+        are discarded
+        :param frame: decoded frame
+        :param checksum: checksum of the compressed image
+        :param request_time: time the request was sent
+        :param arrival: time the response arrived
+        :return: None
+        """
+        with self.lock:
+            self.fetched += 1
+            if request_time < self.request_time:
+                self.outdated += 1
+                return
+            self.frame, self.body_checksum, self.timestamp, self.request_time = frame, checksum, arrival, request_time
+            self.frame_id += 1
+            self.new_frame.notify_all()
+
+    def read(self):
+        """
+        :return: the newest frame, or None if no frame arrived yet
+        """
+        return self.frame
+
+    def read_next(self, frame_id, timeout=None):
+        """
+        Waits for a frame newer than frame_id
+        :param frame_id: id of the last frame the caller has seen, 0 before the first frame
+        :param timeout: seconds to wait at most, None to wait until a frame arrives
+        :return: (frame, arrival timestamp, frame id) of the newest frame, (None, None, frame_id) on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.frame_id <= frame_id:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None, None, frame_id
+                self.new_frame.wait(remaining)
+            return self.frame, self.timestamp, self.frame_id
+
+    def get_stats(self):
+        elapsed = time.time() - self.start_time
+        return {"Fetched_fps": self.fetched / elapsed,
+                "Outdated": self.outdated,
+                "Duplicates": self.duplicates,
+                "Errors": self.errors,
+                "Request_latency": utility.list_avg(list(self.request_latencies))}
+
+
+class FrameReader:
+    """
+    Blocking reads of new frames from a video source. read() waits until the source has a frame the caller has not
+    seen yet, so loops neither spin while no frame has arrived nor process the same frame twice.
+    HTTPFrameSource reports when a frame arrived. Other sources, such as VideoStream, hand out the same array until
+    their thread has read a new frame, and are polled for a different array
+    """
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, camera):
+        """
+        :param camera: video source with a read() method
+        """
+        self.camera = camera
+        self.frame_id = 0
+        self.last_frame = None
+
+    def read(self, timeout=1.0):
+        """
+        :param timeout: seconds to wait at most, None to wait until a frame arrives
+        :return: (frame, arrival timestamp) of a frame newer than the last one returned, (None, None) on timeout
+        """
+        if hasattr(self.camera, "read_next"):
+            frame, arrival, self.frame_id = self.camera.read_next(self.frame_id, timeout)
+            return frame, arrival
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            frame = self.camera.read()
+            if frame is not None and frame is not self.last_frame:
+                self.last_frame = frame
+                return frame, time.time()
+            if deadline is not None and time.time() >= deadline:
+                return None, None
+            time.sleep(self.POLL_INTERVAL)
+
+
+def open_camera(conf):
+    """
+    Opens the video source given by the configuration
+    :param conf: configuration file
+    :return: started video source with a read() method
+    """
+    if conf["run_on_rpi"]:
+        return VideoStream(usePiCamera=True).start()
+    url = 'http://{0}:2067/html/cam_pic_new.php'.format(conf["rpi_IP"])
+    if conf["http_source"]["enabled"]:
+        return HTTPFrameSource(url, conf["http_source"]["in_flight"], conf["http_source"]["timeout"],
+                               conf["frame_width"]).start()
+    return VideoStream(src=url).start()
+
+
+def create_duplicate_filter(conf):
+    """
+    :param conf: configuration file
+    :return: DuplicateFrameFilter configured by conf["duplicate_frames"], or None if disabled
+    """
+    duplicate_conf = conf["duplicate_frames"]
+    if not duplicate_conf["enabled"]:
+        return None
+    return DuplicateFrameFilter(duplicate_conf["threshold"], duplicate_conf["thumbnail_width"])
+
+
+def benchmark_decode(image_path, source_width, width, repetitions):
+    """
+    Compares a full decode followed by a resize with the reduced size decode of JPEGDecoder
+    :param image_path: image that is scaled to source_width and JPEG encoded
+    :param source_width: width of the simulated camera frames
+    :param width: processing width
+    :param repetitions: number of decodes to time
+    :return: None
+    """
+    import imutils
+    image = cv2.imread(image_path)
+    image = cv2.resize(image, (source_width, source_width * 3 // 4), interpolation=cv2.INTER_CUBIC)
+    body = cv2.imencode(".jpg", image)[1].tobytes()
+    decoder = JPEGDecoder(width)
+    decoder.decode(body)
+    print "Source {0}x{1}, processing width {2}, reduction 1/{3}".format(image.shape[1], image.shape[0], width,
+                                                                        decoder.get_flag()[0])
+
+    start = time.time()
+    for _ in range(repetitions):
+        imutils.resize(cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR), width=width)
+    full_time = (time.time() - start) / repetitions
+
+    start = time.time()
+    for _ in range(repetitions):
+        decoder.decode(body)
+    reduced_time = (time.time() - start) / repetitions
+    print "Full decode + resize: {0:.2f} ms, reduced decode: {1:.2f} ms".format(full_time * 1000, reduced_time * 1000)
+
+
+def benchmark_http(image_folder, duration, in_flight_values, delay):
+    """
+    Measures the frame rate of HTTPFrameSource against a local camera_server for each in_flight value
+    :return: None
+    """
+    import camera_server
+    server = camera_server.start_server(image_folder, port=0, delay=delay)
+    url = "http://127.0.0.1:{0}/html/cam_pic_new.php".format(server.server_address[1])
+    print "{0:>10} {1:>10} {2:>14} {3:>8}".format("in_flight", "fps", "latency (ms)", "errors")
+    for in_flight in in_flight_values:
+        source = HTTPFrameSource(url, in_flight=in_flight).start()
+        time.sleep(duration)
+        stats = source.get_stats()
+        source.stop()
+        print "{0:>10} {1:>10.1f} {2:>14.2f} {3:>8}".format(in_flight, stats["Fetched_fps"],
+                                                            stats["Request_latency"] * 1000, stats["Errors"])
+        time.sleep(0.5)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the frame sources")
+    subparsers = parser.add_subparsers(dest="command")
+    http_parser = subparsers.add_parser("http", help="HTTP frame source against a local stand-in camera")
+    http_parser.add_argument("--images", default="images/001_ingunn")
+    http_parser.add_argument("--duration", type=float, default=5)
+    http_parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 2, 4])
+    http_parser.add_argument("--delay", type=float, default=0.02, help="simulated network and camera delay in seconds")
+    decode_parser = subparsers.add_parser("decode", help="reduced size JPEG decode against full decode and resize")
+    decode_parser.add_argument("--image", default="images/001_ingunn/1frame151.jpg")
+    decode_parser.add_argument("--source-width", type=int, default=1296)
+    decode_parser.add_argument("--width", type=int, default=500)
+    decode_parser.add_argument("--repetitions", type=int, default=200)
+    args = parser.parse_args()
+    if args.command == "http":
+        benchmark_http(args.images, args.duration, args.in_flight, args.delay)
+    else:
+        benchmark_decode(args.image, args.source_width, args.width, args.repetitions)
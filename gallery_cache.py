@@ -0,0 +1,270 @@
+import argparse
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import face_recognition as fr
+import utility
+
+
+class GalleryCache:
+    """
+    Persistent store of gallery encodings, saved as a versioned .npz file.
+    Entries are keyed by the image path relative to the image folder, and validated by the
+    image's mtime and the sha1 of its content. Only new or changed images need to be re-encoded.
+    """
+    VERSION = 1
+    ENCODING_SIZE = 128
+
+    def __init__(self, cache_path, image_folder):
+        """
+        :param cache_path: path of the .npz cache file
+        :param image_folder: root folder the cached image paths are relative to
+        """
+        self.cache_path = cache_path
+        self.image_folder = image_folder
+        self.entries = {}
+        self.is_dirty = False
+        self.stats = {"hits": 0, "misses": 0, "rehashed": 0}
+        self.load()
+
+    def load(self):
+        """
+        Loads the cache file if it exists and has the current version. Otherwise starts empty
+        :return: None
+        """
+        self.entries = {}
+        if not os.path.isfile(self.cache_path):
+            return
+        try:
+            with np.load(self.cache_path) as data:
+                if int(data["version"]) != self.VERSION:
+                    return
+                for key, mtime, digest, encoding in zip(data["paths"], data["mtimes"],
+                                                        data["hashes"], data["encodings"]):
+                    self.entries[str(key)] = (float(mtime), str(digest), encoding)
+        except (IOError, KeyError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """
+        Writes the cache to disk. The file is written to a temporary path and renamed,
+        so a reader never sees a partially written cache. The temporary path is unique per process,
+        so processes saving at the same time do not write into each other's file
+        :return: None
+        """
+        keys = sorted(self.entries.keys())
+        encodings = np.zeros((len(keys), self.ENCODING_SIZE), dtype=np.float64)
+        for i, key in enumerate(keys):
+            encodings[i] = self.entries[key][2]
+
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = "{0}.{1}.tmp".format(self.cache_path, os.getpid())
+        with open(tmp_path, "wb") as cache_file:
+            np.savez(cache_file,
+                     version=np.array(self.VERSION),
+                     paths=np.array(keys, dtype=str),
+                     mtimes=np.array([self.entries[key][0] for key in keys], dtype=np.float64),
+                     hashes=np.array([self.entries[key][1] for key in keys], dtype=str),
+                     encodings=encodings)
+        os.rename(tmp_path, self.cache_path)
+        self.is_dirty = False
+
+    def get_key(self, image_path):
+        return os.path.relpath(image_path, self.image_folder)
+
+    @staticmethod
+    def get_file_hash(image_path):
+        """
+        :param image_path: file to hash
+        :return: sha1 hex digest of the file content
+        """
+        with open(image_path, "rb") as image_file:
+            return hashlib.sha1(image_file.read()).hexdigest()
+
+    def get(self, image_path):
+        """
+        Looks up the cached encoding of an image. An entry with a different mtime is only
+        accepted if the content hash still matches, e.g. after copying the cache to another machine
+        :param image_path: path to image
+        :return: cached encoding or None if the image is unknown or has changed
+        """
+        key = self.get_key(image_path)
+        if key not in self.entries:
+            self.stats["misses"] += 1
+            return None
+
+        mtime, digest, encoding = self.entries[key]
+        current_mtime = os.path.getmtime(image_path)
+        if current_mtime != mtime:
+            if self.get_file_hash(image_path) != digest:
+                self.stats["misses"] += 1
+                return None
+            self.entries[key] = (current_mtime, digest, encoding)
+            self.stats["rehashed"] += 1
+            self.is_dirty = True
+
+        self.stats["hits"] += 1
+        return encoding
+
+    def put(self, image_path, encoding):
+        """
+        Stores the encoding of the given image
+        :param image_path: path to image
+        :param encoding: 128-length encoding of the image's face
+        :return: None
+        """
+        self.entries[self.get_key(image_path)] = (os.path.getmtime(image_path),
+                                                  self.get_file_hash(image_path),
+                                                  np.asarray(encoding, dtype=np.float64))
+        self.is_dirty = True
+
+    def prune(self, image_paths):
+        """
+        Removes entries of images that are no longer part of the gallery
+        :param image_paths: paths of all images currently in the gallery
+        :return: number of removed entries
+        """
+        keep = set(self.get_key(path) for path in image_paths)
+        removed = [key for key in self.entries if key not in keep]
+        for key in removed:
+            del self.entries[key]
+        if len(removed) > 0:
+            self.is_dirty = True
+        return len(removed)
+
+    def get_encodings(self, image_paths, workers=1, chunk_size=4):
+        """
+        Returns the encodings of the images, encoding only the cache misses with a pool of workers
+        :param image_paths: paths to images
+        :param workers: number of encoding processes, 0 uses one per cpu
+        :param chunk_size: number of images handed to a worker at a time
+        :return: (encodings, failures). encodings is aligned with image_paths and holds None for images that
+                could not be encoded, failures is a list of (image_path, error message) tuples
+        """
+        encodings = [self.get(image_path) for image_path in image_paths]
+        missing = [i for i in range(len(image_paths)) if encodings[i] is None]
+        results = encode_images([image_paths[i] for i in missing], workers, chunk_size)
+
+        failures = []
+        for i, (encoding, error) in zip(missing, results):
+            if error is None:
+                self.put(image_paths[i], encoding)
+                encodings[i] = encoding
+            else:
+                failures.append((image_paths[i], error))
+        return encodings, failures
+
+
+def encode_image(image_path):
+    """
+    Creates the encoding of the first face found in the image
+    :param image_path: path to image
+    :return: (encoding, error) tuple, encoding is None and error a message if the image could not be encoded
+    """
+    try:
+        encodings = fr.face_encodings(fr.load_image_file(image_path))
+    except (IOError, ValueError) as e:
+        return None, str(e)
+    if len(encodings) == 0:
+        return None, "no face found"
+    return encodings[0], None
+
+
+def encode_images(image_paths, workers=1, chunk_size=4):
+    """
+    Encodes the images, in a process pool if more than one worker is given.
+    Results are returned in the order of image_paths
+    :param image_paths: paths to images
+    :param workers: number of encoding processes, 0 uses one per cpu
+    :param chunk_size: number of images handed to a worker at a time
+    :return: list of (encoding, error) tuples as returned by encode_image
+    """
+    if workers == 0:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(image_paths))
+    if workers <= 1:
+        return [encode_image(image_path) for image_path in image_paths]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(encode_image, image_paths, chunksize=chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_gallery_images(image_folder):
+    """
+    Lists every image of the gallery, in the sorted order that defines the user indexes
+    :param image_folder: folder with one sub-folder per user
+    :return: list of image paths
+    """
+    paths = []
+    for directory in utility.get_sorted_directory(image_folder):
+        dir_path = os.path.join(image_folder, directory)
+        if os.path.isdir(dir_path):
+            paths.extend(os.path.join(dir_path, image) for image in utility.get_sorted_directory(dir_path))
+    return paths
+
+
+def build(cache, image_folder, workers, chunk_size):
+    """
+    Encodes every new or changed image in the gallery and removes entries of deleted images
+    :return: None
+    """
+    start = time.time()
+    images = get_gallery_images(image_folder)
+    _, failures = cache.get_encodings(images, workers, chunk_size)
+    removed = cache.prune(images)
+    if cache.is_dirty:
+        cache.save()
+    print "Cached {0} images in {1:.2f}s (hits: {2}, encoded: {3}, failed: {4}, removed: {5})".format(
+        len(images), time.time() - start, cache.stats["hits"], cache.stats["misses"] - len(failures),
+        len(failures), removed)
+    for image_path, error in failures:
+        print "  Could not encode {0}: {1}".format(image_path, error)
+
+
+def inspect_cache(cache, image_folder):
+    """
+    Prints the cache content and whether each gallery image is up to date
+    :return: None
+    """
+    print "Cache file: {0} (version {1})".format(cache.cache_path, cache.VERSION)
+    print "Entries: {0}".format(len(cache.entries))
+    images = get_gallery_images(image_folder)
+    stale = [path for path in images if cache.get(path) is None]
+    known = set(cache.get_key(path) for path in images)
+    orphans = [key for key in cache.entries if key not in known]
+    for key in sorted(cache.entries):
+        mtime, digest, _ = cache.entries[key]
+        print "  {0}  {1}  {2}".format(digest[:12], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime)), key)
+    print "Stale or missing: {0}".format(len(stale))
+    for path in stale:
+        print "  {0}".format(cache.get_key(path))
+    print "Orphaned: {0}".format(len(orphans))
+
+
+if __name__ == "__main__":
+    path_to_file = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    conf = json.load(open(path_to_file + '/conf.json'))
+
+    parser = argparse.ArgumentParser(description="Build or inspect the gallery encoding cache")
+    parser.add_argument("command", choices=["build", "inspect"])
+    parser.add_argument("--images", default=os.path.join(path_to_file, "images"))
+    parser.add_argument("--cache", default=os.path.join(path_to_file, conf["gallery_cache_path"]))
+    parser.add_argument("--workers", type=int, default=conf["enrollment_workers"])
+    parser.add_argument("--chunk-size", type=int, default=conf["enrollment_chunk_size"])
+    args = parser.parse_args()
+
+    gallery_cache = GalleryCache(args.cache, args.images)
+    if args.command == "build":
+        build(gallery_cache, args.images, args.workers, args.chunk_size)
+    else:
+        inspect_cache(gallery_cache, args.images)
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+class GalleryMatcher:
+    """
+    Matches face encodings against the whole gallery at once.
+    The gallery is kept as one contiguous float32 matrix, sorted by user, with a parallel array of user ids
+    """
+
+    def __init__(self, encodings, user_ids, tolerance=0.6, method="vote", index=None, neighbours=32):
+        """
+        :param encodings: list or matrix of 128-length gallery encodings
+        :param user_ids: user index of each encoding
+        :param tolerance: maximum distance between two encodings of the same person
+        :param method: aggregation of the distances to a user:
+            Choices:
+                "vote": user with the most gallery encodings within tolerance, ties broken by distance
+                "distance": user with the closest gallery encoding within tolerance
+        :param index: optional ann_index.IVFIndex built from self.encodings. If given, only the approximate
+                nearest neighbours of each face are scored instead of the whole gallery
+        :param neighbours: number of nearest neighbours retrieved from the index per face
+        """
+        self.tolerance = tolerance
+        self.method = method
+        self.index = index
+        self.neighbours = neighbours
+
+        user_ids = np.asarray(user_ids, dtype=np.int32)
+        order = np.argsort(user_ids, kind="mergesort")
+        self.user_ids = user_ids[order]
+        self.encodings = np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(-1, 128)[order])
+        self.squared_norms = np.einsum("ij,ij->i", self.encodings, self.encodings)
+
+        self.users, self.user_starts, self.user_positions = np.unique(self.user_ids, return_index=True,
+                                                                      return_inverse=True)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def get_distances(self, queries):
+        """
+        Computes the euclidean distance from every query to every gallery encoding
+        :param queries: matrix of shape (number of faces, 128)
+        :return: distance matrix of shape (number of faces, gallery size)
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, 128)
+        squared = np.einsum("ij,ij->i", queries, queries)[:, None] + self.squared_norms[None, :] \
+            - 2 * queries.dot(self.encodings.T)
+        return np.sqrt(np.maximum(squared, 0, out=squared), out=squared)
+
+    def get_user_distances(self, distances):
+        """
+        :param distances: distance matrix from get_distances
+        :return: matrix of shape (number of faces, number of users) with the closest distance to each user
+        """
+        return np.minimum.reduceat(distances, self.user_starts, axis=1)
+
+    def get_user_votes(self, distances):
+        """
+        Counts, for every face, the gallery encodings of each user within tolerance
+        :param distances: distance matrix from get_distances
+        :return: matrix of shape (number of faces, number of users) with vote counts
+        """
+        num_faces = distances.shape[0]
+        num_users = len(self.users)
+        rows, columns = np.nonzero(distances <= self.tolerance)
+        bins = rows * num_users + self.user_positions[columns]
+        return np.bincount(bins, minlength=num_faces * num_users).reshape(num_faces, num_users)
+
+    def get_neighbour_scores(self, queries):
+        """
+        Computes per-user distances and votes from the approximate nearest neighbours found by self.index
+        Users without a retrieved neighbour get distance inf and no votes
+        :param queries: list or matrix of 128-length encodings
+        :return: (user_distances, votes) matrices of shape (number of faces, number of users)
+        """
+        indexes, distances = self.index.search(queries, self.neighbours)
+        rows, columns = np.nonzero(indexes >= 0)
+        positions = self.user_positions[indexes[rows, columns]]
+        found = distances[rows, columns]
+
+        user_distances = np.full((len(indexes), len(self.users)), np.inf, dtype=np.float32)
+        np.minimum.at(user_distances, (rows, positions), found)
+        within = found <= self.tolerance
+        bins = rows[within] * len(self.users) + positions[within]
+        votes = np.bincount(bins, minlength=user_distances.size).reshape(user_distances.shape)
+        return user_distances, votes
+
+    def match(self, queries):
+        """
+        Finds the user of every query encoding
+        :param queries: list or matrix of 128-length encodings
+        :return: (labels, distances) arrays. The label is the user index or -1 if unknown, and the distance
+                is the closest distance to the chosen user
+        """
+        if len(queries) == 0 or len(self) == 0:
+            return np.full(len(queries), -1, dtype=np.int32), np.full(len(queries), np.inf, dtype=np.float32)
+
+        if self.index is not None:
+            user_distances, votes = self.get_neighbour_scores(queries)
+        else:
+            distances = self.get_distances(queries)
+            user_distances = self.get_user_distances(distances)
+            votes = self.get_user_votes(distances) if self.method == "vote" else None
+
+        if self.method == "vote":
+            is_candidate = votes == votes.max(axis=1)[:, None]
+            positions = np.argmin(np.where(is_candidate, user_distances, np.inf), axis=1)
+        else:
+            positions = np.argmin(user_distances, axis=1)
+
+        rows = np.arange(len(positions))
+        best_distances = user_distances[rows, positions]
+        labels = np.where(best_distances <= self.tolerance, self.users[positions], -1).astype(np.int32)
+        return labels, best_distances
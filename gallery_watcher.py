@@ -0,0 +1,60 @@
+import os
+import threading
+import utility
+
+
+class GalleryWatcher(threading.Thread):
+    """
+    Polls the mtimes of the image folder and its user folders, and calls on_change when the gallery changed.
+    A change is only reported once two consecutive polls agree, so images still being copied are not read
+    """
+
+    def __init__(self, image_folder, interval, on_change):
+        """
+        :param image_folder: folder with one sub-folder per user
+        :param interval: seconds between polls
+        :param on_change: function called, on the watcher thread, when the gallery changed
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.image_folder = image_folder
+        self.interval = interval
+        self.on_change = on_change
+        self.stopped = threading.Event()
+        self.loaded_snapshot = self.get_snapshot(image_folder)
+
+    @staticmethod
+    def get_snapshot(image_folder):
+        """
+        :param image_folder: folder with one sub-folder per user
+        :return: dictionary of path -> mtime for every user folder and image
+        """
+        snapshot = {}
+        for directory in utility.get_sorted_directory(image_folder):
+            dir_path = os.path.join(image_folder, directory)
+            if not os.path.isdir(dir_path):
+                continue
+            try:
+                snapshot[dir_path] = os.path.getmtime(dir_path)
+                for image in os.listdir(dir_path):
+                    image_path = os.path.join(dir_path, image)
+                    snapshot[image_path] = os.path.getmtime(image_path)
+            except OSError:
+                # the folder changed while it was listed, the next poll will see the result
+                continue
+        return snapshot
+
+    def run(self):
+        previous_snapshot = self.loaded_snapshot
+        while not self.stopped.wait(self.interval):
+            snapshot = self.get_snapshot(self.image_folder)
+            if snapshot != self.loaded_snapshot and snapshot == previous_snapshot:
+                self.loaded_snapshot = snapshot
+                try:
+                    self.on_change()
+                except Exception as e:
+                    print "Gallery reload failed: {0}".format(e)
+            previous_snapshot = snapshot
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,139 @@
+import collections
+import time
+import cv2
+import frame_source
+import utility
+
+
+class IdleMonitor:
+    """
+    Puts the recognition loop to sleep while nobody is in front of the mirror.
+    After idle_after seconds without motion, faces or a logged in user the monitor turns idle: frames are only
+    compared as small thumbnails at idle_fps, and a video source supporting set_rate is throttled to that rate.
+    The first frame with motion wakes the monitor up and is processed in full right away.
+    Wake-up latency is the time from reading that frame to the end of its full processing
+    """
+
+    def __init__(self, conf, camera=None):
+        """
+        :param conf: configuration file, its "idle" section configures the monitor
+        :param camera: video source, throttled while idle if it has a set_rate method
+        """
+        idle_conf = conf["idle"]
+        self.idle_after = idle_conf["idle_after"]
+        self.idle_fps = idle_conf["idle_fps"]
+        self.idle_interval = 1 / float(idle_conf["idle_fps"])
+        self.thumbnail_width = idle_conf["thumbnail_width"]
+        self.pixel_threshold = idle_conf["pixel_threshold"]
+        self.min_changed_fraction = idle_conf["min_changed_fraction"]
+        self.set_rate = getattr(camera, "set_rate", None)
+
+        self.idle = False
+        self.waking = False
+        self.wake_time = None
+        self.last_activity = time.time()
+        self.last_frame = None
+        self.last_thumbnail = None
+
+        self.idle_since = None
+        self.idle_seconds = 0
+        self.idle_frames = 0
+        self.wakeups = 0
+        self.wake_latencies = collections.deque(maxlen=100)
+        self.start_time = time.time()
+
+    def has_motion(self, frame):
+        """
+        Compares a thumbnail of the frame with the thumbnail of the previous frame
+        :param frame: new frame
+        :return: True if at least min_changed_fraction of the thumbnail pixels changed by more than pixel_threshold
+        """
+        if frame is self.last_frame:
+            return False
+        thumbnail = frame_source.get_thumbnail(frame, self.thumbnail_width)
+        previous = self.last_thumbnail
+        self.last_frame, self.last_thumbnail = frame, thumbnail
+        if previous is None or previous.shape != thumbnail.shape:
+            return False
+        changed = cv2.threshold(cv2.absdiff(thumbnail, previous), self.pixel_threshold, 255, cv2.THRESH_BINARY)[1]
+        return cv2.countNonZero(changed) >= self.min_changed_fraction * changed.size
+
+    def check_idle(self, frame, timestamp):
+        """
+        Called for every frame before it is processed
+        :param frame: new frame
+        :param timestamp: time the frame was read
+        :return: True if the monitor is idle and the frame should be skipped
+        """
+        self.waking = False
+        if not self.idle:
+            return False
+        self.idle_frames += 1
+        if not self.has_motion(frame):
+            return True
+        self.wake_up(timestamp)
+        return False
+
+    def update(self, active, timestamp):
+        """
+        Called after a frame was processed in full
+        :param active: True if the frame had motion or faces, or a user is logged in
+        :param timestamp: time the frame was read
+        :return: None
+        """
+        now = time.time()
+        if self.wake_time is not None:
+            self.wake_latencies.append(now - self.wake_time)
+            self.wake_time = None
+        if active:
+            self.last_activity = timestamp
+        elif timestamp - self.last_activity > self.idle_after:
+            self.go_idle(now)
+
+    def go_idle(self, now):
+        self.idle = True
+        self.idle_since = now
+        # the first idle frame becomes the reference for motion
+        self.last_frame = self.last_thumbnail = None
+        if self.set_rate is not None:
+            self.set_rate(self.idle_fps)
+
+    def wake_up(self, timestamp):
+        self.idle = False
+        self.waking = True
+        self.wake_time = timestamp
+        self.last_activity = timestamp
+        self.wakeups += 1
+        self.idle_seconds += time.time() - self.idle_since
+        if self.set_rate is not None:
+            self.set_rate(None)
+
+    def wait(self, timestamp):
+        """
+        Sleeps out the rest of the idle frame interval
+        :param timestamp: time the frame was read
+        :return: None
+        """
+        remaining = self.idle_interval - (time.time() - timestamp)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def get_stats(self):
+        idle_seconds = self.idle_seconds + (time.time() - self.idle_since if self.idle else 0)
+        return {"Idle": self.idle,
+                "Idle_fraction": idle_seconds / (time.time() - self.start_time),
+                "Idle_frames": self.idle_frames,
+                "Wakeups": self.wakeups,
+                "Wake_latency": utility.list_avg(list(self.wake_latencies)),
+                "Max_wake_latency": max(self.wake_latencies) if len(self.wake_latencies) > 0 else 0}
+
+
+def create_idle_monitor(conf, camera=None):
+    """
+    :param conf: configuration file
+    :param camera: video source, throttled while idle if it has a set_rate method
+    :return: IdleMonitor configured by conf["idle"], or None if disabled
+    """
+    if not conf["idle"]["enabled"]:
+        return None
+    return IdleMonitor(conf, camera)
@@ -0,0 +1,224 @@
+import collections
+import inspect
+import json
+import os
+import threading
+import time
+import cv2
+from imutils.video import VideoStream
+import background_subtractor as bgsub
+import frame_source
+import user_recognizer
+import utility
+
+
+class CameraStream:
+    """
+    One camera with its own background model and login state machine
+    """
+    # seconds to wait for a new frame before the login state is checked again
+    READ_TIMEOUT = 0.5
+
+    def __init__(self, camera_conf, conf, path_to_file, face_recognizer):
+        """
+        :param camera_conf: entry of conf["multi_camera"]["cameras"] with keys "name", "source" and "rpi_IP"
+        :param conf: configuration file
+        :param path_to_file: directory of working directory
+        :param face_recognizer: face recognition model shared by all streams
+        """
+        self.name = camera_conf["name"]
+        self.camera = VideoStream(src=camera_conf["source"]).start()
+        self.reader = frame_source.FrameReader(self.camera)
+        self.user_rec = user_recognizer.UserRecognizer(conf, face_recognizer=face_recognizer,
+                                                       rpi_ip=camera_conf["rpi_IP"])
+        self.conf = conf
+        self.path_to_file = path_to_file
+        self.bg_sub_model = None
+        self.lock = threading.Lock()
+
+        self.frame = None
+        self.face_locations = []
+        self.face_names = []
+        # number of the newest frame whose faces were applied to the login state
+        self.last_applied = -1
+
+        self.captured = 0
+        self.recognized = 0
+        self.stale = 0
+        self.start_time = time.time()
+        self.detection_latencies = collections.deque(maxlen=100)
+        self.recognition_latencies = collections.deque(maxlen=100)
+
+    def detect(self):
+        """
+        Waits for a frame newer than the last one, resizes it and detects faces in it with this stream's
+        background model
+        :return: (frame number, frame, face locations, arrival timestamp), or None if no new frame arrived in time
+        """
+        raw_frame, timestamp = self.reader.read(self.READ_TIMEOUT)
+        if raw_frame is None:
+            return None
+        frame = frame_source.resize_to_width(raw_frame, self.conf["frame_width"])
+        if self.bg_sub_model is None:
+            self.bg_sub_model = bgsub.BackgroundExtractor(frame, self.conf, self.path_to_file)
+        face_locations = self.bg_sub_model.detect_face(frame)
+        frame_number = self.captured
+        self.captured += 1
+        self.detection_latencies.append(time.time() - timestamp)
+        return frame_number, frame, face_locations, timestamp
+
+    def recognize(self, frame_number, frame, face_locations, timestamp):
+        """
+        Identifies the faces with the shared model and advances this stream's login state machine.
+        Encoders may finish the jobs of a stream out of order, results older than the last applied one are dropped
+        :return: None
+        """
+        face_names = self.user_rec.identify_faces(frame, face_locations)
+        with self.lock:
+            if frame_number < self.last_applied:
+                self.stale += 1
+                return
+            self.last_applied = frame_number
+            self.user_rec.update_detection_list(face_names)
+            self.user_rec.check_login()
+            self.frame, self.face_locations, self.face_names = frame, face_locations, face_names
+        self.recognized += 1
+        self.recognition_latencies.append(time.time() - timestamp)
+
+    def check_logout(self):
+        with self.lock:
+            self.user_rec.check_logout()
+
+    def get_stats(self):
+        elapsed = time.time() - self.start_time
+        return {"Capture_fps": self.captured / elapsed,
+                "Recognition_fps": self.recognized / elapsed,
+                "Detection_latency": utility.list_avg(list(self.detection_latencies)),
+                "End_to_end_latency": utility.list_avg(list(self.recognition_latencies)),
+                "Stale_results": self.stale,
+                "User": self.user_rec.current_user}
+
+    def stop(self):
+        self.camera.stop()
+
+
+class RoundRobinScheduler:
+    """
+    Holds at most one pending encoding job per stream, the newest one replacing an older job.
+    Jobs are handed out in round-robin order over the streams, so a busy camera cannot starve the others
+    """
+
+    def __init__(self, num_streams):
+        self.pending = [None] * num_streams
+        self.next_stream = 0
+        self.condition = threading.Condition()
+        self.replaced = [0] * num_streams
+
+    def submit(self, stream_index, job):
+        with self.condition:
+            if self.pending[stream_index] is not None:
+                self.replaced[stream_index] += 1
+            self.pending[stream_index] = job
+            self.condition.notify()
+
+    def get(self, timeout=0.1):
+        """
+        :param timeout: seconds to wait for a job
+        :return: (stream_index, job) of the next stream in turn that has a job, or None
+        """
+        with self.condition:
+            if all(job is None for job in self.pending):
+                self.condition.wait(timeout)
+            for offset in range(len(self.pending)):
+                stream_index = (self.next_stream + offset) % len(self.pending)
+                job = self.pending[stream_index]
+                if job is not None:
+                    self.pending[stream_index] = None
+                    self.next_stream = (stream_index + 1) % len(self.pending)
+                    return stream_index, job
+            return None
+
+
+class MultiCameraRecognizer:
+    """
+    Runs detection on one thread per camera, and face encoding on a shared pool of encoder threads
+    fed by a round-robin scheduler. All streams share one loaded gallery and encoder
+    """
+
+    def __init__(self, conf, path_to_file):
+        multi_conf = conf["multi_camera"]
+        face_recognizer = user_recognizer.UserRecognizer.create_face_recognizer(conf)
+        self.streams = [CameraStream(camera_conf, conf, path_to_file, face_recognizer)
+                        for camera_conf in multi_conf["cameras"]]
+        self.scheduler = RoundRobinScheduler(len(self.streams))
+        self.running = False
+        self.threads = [threading.Thread(target=self.run_stream, args=(i,)) for i in range(len(self.streams))]
+        self.threads += [threading.Thread(target=self.run_encoder) for _ in range(multi_conf["encoder_workers"])]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        self.running = True
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for stream in self.streams:
+            stream.stop()
+
+    def run_stream(self, stream_index):
+        stream = self.streams[stream_index]
+        while self.running:
+            detection = stream.detect()
+            if detection is None:
+                stream.check_logout()
+                continue
+            if len(detection[2]) > 0:
+                self.scheduler.submit(stream_index, detection)
+            stream.check_logout()
+
+    def run_encoder(self):
+        while self.running:
+            scheduled = self.scheduler.get()
+            if scheduled is not None:
+                stream_index, job = scheduled
+                self.streams[stream_index].recognize(*job)
+
+    def get_stats(self):
+        stats = {}
+        for stream_index, stream in enumerate(self.streams):
+            stats[stream.name] = stream.get_stats()
+            stats[stream.name]["Replaced_jobs"] = self.scheduler.replaced[stream_index]
+        return stats
+
+
+if __name__ == "__main__":
+    path_to_file = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    conf = json.load(open(path_to_file + '/conf.json'))
+
+    recognizer = MultiCameraRecognizer(conf, path_to_file)
+    time.sleep(conf["camera_warmup_time"])
+    recognizer.start()
+    print "Init multi camera recognition"
+    stats_time = time.time()
+    try:
+        while True:
+            if conf["show_video"]["recognition"] and not conf["headless"]:
+                for camera_stream in recognizer.streams:
+                    with camera_stream.lock:
+                        if camera_stream.frame is not None:
+                            camera_stream.user_rec.show_recognized_face(camera_stream.frame,
+                                                                        camera_stream.face_locations,
+                                                                        camera_stream.face_names,
+                                                                        window="Video " + camera_stream.name)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+            else:
+                time.sleep(0.1)
+            if time.time() - stats_time > conf["multi_camera"]["stats_interval"]:
+                print recognizer.get_stats()
+                stats_time = time.time()
+    except KeyboardInterrupt:
+        pass
+    recognizer.stop()
@@ -1,6 +1,7 @@
 import cv2
 import os
 import time
+import frame_context
 import utility
 
 
@@ -45,7 +46,7 @@ class FaceRecModel:
     def recognize_face(self, frame, locations):
         start_time = time.time()
         names = []
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        frame = frame_context.get_context(frame).get_gray()
         for location in locations:
             x, y, w, h = utility.convert_dlib_location_to_opencv(location)
 
@@ -0,0 +1,216 @@
+import threading
+import time
+import collections
+import utility
+import frame_source
+
+
+class DropOldestQueue:
+    """
+    Bounded queue that discards its oldest item when a new item is put while it is full,
+    so consumers always get the freshest frames
+    """
+
+    def __init__(self, maxsize):
+        self.items = collections.deque()
+        self.maxsize = maxsize
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: seconds to wait for an item
+        :return: the oldest item, or None if the timeout passed
+        """
+        with self.condition:
+            if len(self.items) == 0:
+                self.condition.wait(timeout)
+            if len(self.items) == 0:
+                return None
+            return self.items.popleft()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class FramePacket:
+
+    def __init__(self, frame_number, frame, timestamp):
+        """
+        :param frame_number: increasing number of the captured frame
+        :param frame: resized frame
+        :param timestamp: time the frame arrived from the camera, before any processing
+        """
+        self.frame_number = frame_number
+        self.timestamp = timestamp
+        self.frame = frame
+        self.face_locations = []
+        self.face_names = []
+        self.stage_times = {}
+
+
+class Stage:
+    """
+    Runs function on every packet of the input queue with a number of worker threads and puts the
+    returned packets on the output queue. OpenCV releases the GIL, so cascade detection runs in parallel.
+    face_recognition keeps one module-global dlib model per process, which every thread shares, so several
+    recognition workers do not encode faster; use the "processes" pipeline mode to encode in parallel
+    """
+
+    def __init__(self, name, function, input_queue, output_queue, workers=1):
+        self.name = name
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.workers = [threading.Thread(target=self.run, name="{0}-{1}".format(name, i)) for i in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+        self.running = False
+        self.latencies = collections.deque(maxlen=100)
+        self.processed = 0
+
+    def start(self):
+        self.running = True
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            packet = self.input_queue.get(timeout=0.1)
+            if packet is None:
+                continue
+            start = time.time()
+            self.function(packet)
+            packet.stage_times[self.name] = time.time() - start
+            self.latencies.append(packet.stage_times[self.name])
+            self.processed += 1
+            self.output_queue.put(packet)
+
+    def get_stats(self):
+        return {"processed": self.processed,
+                "queue_depth": len(self.input_queue),
+                "dropped": self.input_queue.dropped,
+                "latency": utility.list_avg(list(self.latencies))}
+
+
+class RecognitionPipeline:
+    """
+    Capture, detection and recognition run as separate stages connected by bounded queues that drop the
+    oldest frame. The caller consumes the recognized packets with get_result and runs the login state machine
+    """
+
+    def __init__(self, camera, user_recognizer, bg_sub_model, conf):
+        """
+        :param camera: video source with a read() method
+        :param user_recognizer: UserRecognizer used to identify faces
+        :param bg_sub_model: BackgroundExtractor used to detect faces
+        :param conf: configuration file, its "pipeline" section configures the stages
+        """
+        pipeline_conf = conf["pipeline"]
+        self.camera = camera
+        self.reader = frame_source.FrameReader(camera)
+        self.user_recognizer = user_recognizer
+        self.bg_sub_model = bg_sub_model
+        self.capture_interval = 1 / float(pipeline_conf["capture_fps"])
+        self.frame_width = conf["frame_width"]
+
+        self.capture_queue = DropOldestQueue(pipeline_conf["queue_size"])
+        self.detection_queue = DropOldestQueue(pipeline_conf["queue_size"])
+        self.result_queue = DropOldestQueue(pipeline_conf["queue_size"])
+
+        # the background model is updated by every detection, so it must only be used by one thread
+        detection_workers = 1 if conf["do_bgsub"] else pipeline_conf["detection_workers"]
+        self.stages = [Stage("Detection", self.detect, self.capture_queue, self.detection_queue, detection_workers),
+                       Stage("Recognition", self.recognize, self.detection_queue, self.result_queue,
+                             pipeline_conf["recognition_workers"])]
+
+        self.duplicate_filter = frame_source.create_duplicate_filter(conf)
+        self.capture_thread = threading.Thread(target=self.capture, name="Capture")
+        self.capture_thread.daemon = True
+        self.running = False
+        self.frame_number = 0
+        self.last_result_number = -1
+        self.out_of_order = 0
+        self.end_to_end_latencies = collections.deque(maxlen=100)
+
+    def start(self):
+        self.running = True
+        for stage in self.stages:
+            stage.start()
+        self.capture_thread.start()
+
+    def stop(self):
+        self.running = False
+        for stage in self.stages:
+            stage.stop()
+
+    def is_duplicate(self, frame):
+        return self.duplicate_filter is not None and self.duplicate_filter.is_duplicate(frame)
+
+    def capture(self):
+        while self.running:
+            start = time.time()
+            frame, timestamp = self.reader.read()
+            if frame is not None and not self.is_duplicate(frame):
+                frame = frame_source.resize_to_width(frame, self.frame_width)
+                self.capture_queue.put(FramePacket(self.frame_number, frame, timestamp))
+                self.frame_number += 1
+            elapsed = time.time() - start
+            if elapsed < self.capture_interval:
+                time.sleep(self.capture_interval - elapsed)
+
+    def detect(self, packet):
+        packet.face_locations = self.bg_sub_model.detect_face(packet.frame)
+
+    def recognize(self, packet):
+        packet.face_names = self.user_recognizer.identify_faces(packet.frame, packet.face_locations)
+
+    def count_duplicates(self):
+        """
+        Duplicate frames are only counted, they never become results and so never vote for a login
+        :return: number of duplicate frames skipped since the start
+        """
+        return self.duplicate_filter.skipped if self.duplicate_filter is not None else 0
+
+    def get_result(self, timeout=1.0):
+        """
+        Returns the next recognized packet. Packets overtaken by a newer frame are discarded,
+        so results are always in frame order
+        :param timeout: seconds to wait for a result
+        :return: FramePacket or None if no result arrived in time
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            packet = self.result_queue.get(timeout=max(0, deadline - time.time()))
+            if packet is None:
+                return None
+            if packet.frame_number < self.last_result_number:
+                self.out_of_order += 1
+                continue
+            self.last_result_number = packet.frame_number
+            self.end_to_end_latencies.append(time.time() - packet.timestamp)
+            return packet
+        return None
+
+    def get_stats(self):
+        """
+        :return: dictionary with queue depth, dropped frames, and latency for each stage and end to end
+        """
+        stats = {stage.name: stage.get_stats() for stage in self.stages}
+        stats["Captured"] = self.frame_number
+        stats["Out_of_order"] = self.out_of_order
+        if self.duplicate_filter is not None:
+            stats.update(self.duplicate_filter.get_stats())
+        stats["End_to_end_latency"] = utility.list_avg(list(self.end_to_end_latencies))
+        return stats
@@ -0,0 +1,198 @@
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+import cv2
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class PreviewServer:
+    """
+    Serves the debug views (annotated frame, blur, average, contour...) as MJPEG streams over HTTP.
+    Producers publish references to their latest data, which is cheap. Rendering and JPEG encoding happen on
+    the server's own thread at most max_fps times per second, and only for views a client is watching
+    """
+
+    def __init__(self, port=8090, max_fps=5, quality=80, host="127.0.0.1"):
+        """
+        :param port: port to listen on
+        :param max_fps: maximum rate at which each watched view is encoded
+        :param quality: JPEG quality of the streamed images
+        :param host: address to listen on. The streams are not authenticated, so only this machine can watch
+                them by default, "" listens on every interface
+        """
+        self.host = host
+        self.port = port
+        self.interval = 1 / float(max_fps)
+        self.quality = quality
+
+        self.condition = threading.Condition()
+        self.renderers = {}
+        self.data = {}
+        self.versions = {}
+        self.encoded = {}
+        self.encoded_versions = {}
+        self.watchers = {}
+        self.running = False
+        self.server = None
+
+    def add_view(self, view, renderer=None):
+        """
+        :param view: name of the view, served at /<view>
+        :param renderer: function turning the published data into an image, None if the data is the image
+        :return: None
+        """
+        with self.condition:
+            self.renderers[view] = renderer
+            self.versions.setdefault(view, 0)
+            self.watchers.setdefault(view, 0)
+
+    def is_watched(self, view):
+        """
+        Producers should only compute data for a view while it is watched
+        :param view: name of the view
+        :return: True if a client is streaming the view
+        """
+        return self.watchers.get(view, 0) > 0
+
+    def publish(self, view, data):
+        """
+        Stores a reference to the newest data of the view. Nothing is rendered unless the view is watched
+        :param view: name of the view
+        :param data: image, or the argument tuple of the view's renderer
+        :return: None
+        """
+        if not self.is_watched(view):
+            return
+        with self.condition:
+            self.data[view] = data
+            self.versions[view] = self.versions.get(view, 0) + 1
+
+    def start(self):
+        self.running = True
+        self.server = ThreadingHTTPServer((self.host, self.port), create_handler(self))
+        for target in (self.server.serve_forever, self.encode):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.server is not None:
+            self.server.shutdown()
+
+    def render(self, view, data):
+        renderer = self.renderers.get(view)
+        return renderer(*data) if renderer is not None else data
+
+    def encode(self):
+        """
+        Encoder thread. Renders and encodes the new data of each watched view at a capped rate
+        """
+        while self.running:
+            start = time.time()
+            with self.condition:
+                pending = [(view, self.data[view], self.versions[view]) for view in self.data
+                           if self.is_watched(view) and self.versions[view] != self.encoded_versions.get(view)]
+            for view, data, version in pending:
+                success, jpeg = cv2.imencode(".jpg", self.render(view, data),
+                                             [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+                if success:
+                    with self.condition:
+                        self.encoded[view] = jpeg.tostring()
+                        self.encoded_versions[view] = version
+                        self.condition.notify_all()
+            elapsed = time.time() - start
+            if elapsed < self.interval:
+                time.sleep(self.interval - elapsed)
+
+    def watch(self, view):
+        with self.condition:
+            self.watchers[view] += 1
+
+    def unwatch(self, view):
+        with self.condition:
+            self.watchers[view] -= 1
+            if self.watchers[view] == 0:
+                self.data.pop(view, None)
+
+    def wait_for_jpeg(self, view, last_version, timeout=1.0):
+        """
+        :return: (jpeg, version) of the view once it is newer than last_version, or (None, last_version)
+        """
+        with self.condition:
+            if self.encoded_versions.get(view, 0) == last_version:
+                self.condition.wait(timeout)
+            version = self.encoded_versions.get(view, 0)
+            if version == last_version:
+                return None, last_version
+            return self.encoded[view], version
+
+
+def create_handler(preview):
+    """
+    :param preview: PreviewServer whose views are served
+    :return: request handler class serving an index page at / and an MJPEG stream per view at /<view>
+    """
+
+    class PreviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            view = self.path.strip("/")
+            if view == "":
+                self.send_index()
+            elif view in preview.renderers:
+                self.send_stream(view)
+            else:
+                self.send_error(404)
+
+        def send_index(self):
+            body = "<html><body>" + "".join('<h3>{0}</h3><img src="/{0}">'.format(view)
+                                            for view in sorted(preview.renderers)) + "</body></html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_stream(self, view):
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+            self.end_headers()
+            preview.watch(view)
+            version = 0
+            try:
+                while preview.running:
+                    jpeg, version = preview.wait_for_jpeg(view, version)
+                    if jpeg is None:
+                        continue
+                    self.wfile.write("--frame\r\nContent-Type: image/jpeg\r\nContent-Length: {0}\r\n\r\n".format(
+                        len(jpeg)))
+                    self.wfile.write(jpeg)
+                    self.wfile.write("\r\n")
+            except IOError:
+                # client disconnected
+                pass
+            finally:
+                preview.unwatch(view)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PreviewHandler
+
+
+def create_preview_server(conf):
+    """
+    :param conf: configuration file
+    :return: started PreviewServer configured by conf["preview_server"], or None if disabled
+    """
+    preview_conf = conf["preview_server"]
+    if not preview_conf["enabled"]:
+        return None
+    return PreviewServer(preview_conf["port"], preview_conf["max_fps"], preview_conf["quality"],
+                         preview_conf["host"]).start()
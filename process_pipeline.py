@@ -0,0 +1,348 @@
+import ctypes
+import heapq
+import multiprocessing
+import Queue
+import threading
+import time
+import collections
+import numpy as np
+import background_subtractor as bgsub
+import pipeline
+import user_recognizer
+import utility
+import frame_source
+
+
+class SharedFrameRing:
+    """
+    Ring buffer of frames in shared memory. Worker processes read a frame in place by its slot index,
+    so frames are never pickled. Each slot records the number of the frame it holds, which is -1 while the
+    slot is written. Readers check it after using the frame to detect that it was overwritten meanwhile
+    """
+
+    def __init__(self, num_slots, shape):
+        """
+        :param num_slots: number of frames the ring holds
+        :param shape: shape of every frame (height, width, channels)
+        """
+        self.num_slots = num_slots
+        self.shape = shape
+        self.slot_size = int(np.prod(shape))
+        self.buffer = multiprocessing.RawArray(ctypes.c_uint8, num_slots * self.slot_size)
+        self.frame_numbers = multiprocessing.RawArray(ctypes.c_long, [-1] * num_slots)
+
+    def get_slot(self, slot):
+        return np.frombuffer(self.buffer, dtype=np.uint8, count=self.slot_size,
+                             offset=slot * self.slot_size).reshape(self.shape)
+
+    def write(self, frame_number, frame):
+        """
+        Copies the frame into its slot
+        :param frame_number: increasing number of the frame
+        :param frame: image of shape self.shape
+        :return: slot index the frame was written to
+        """
+        slot = frame_number % self.num_slots
+        self.frame_numbers[slot] = -1
+        self.get_slot(slot)[...] = frame
+        self.frame_numbers[slot] = frame_number
+        return slot
+
+    def is_valid(self, slot, frame_number):
+        return self.frame_numbers[slot] == frame_number
+
+    def read(self, slot, frame_number):
+        """
+        :return: view of the frame in shared memory, or None if the slot no longer holds frame_number
+        """
+        return self.get_slot(slot) if self.is_valid(slot, frame_number) else None
+
+    def copy(self, slot, frame_number):
+        """
+        :return: copy of the frame, or None if the slot was overwritten before or while it was copied
+        """
+        frame = self.read(slot, frame_number)
+        if frame is None:
+            return None
+        frame = frame.copy()
+        return frame if self.is_valid(slot, frame_number) else None
+
+
+def run_detection(ring, task_queue, recognition_queue, result_queue, conf, path_to_file):
+    """
+    Detection worker process. Frames without faces are answered directly, the others are passed on to recognition
+    Every task produces exactly one result, with locations None if the frame was overwritten before it was used
+    """
+    bg_sub_model = None
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        frame_number, slot, timestamp = task
+        frame = ring.read(slot, frame_number)
+        if frame is None:
+            result_queue.put((frame_number, slot, timestamp, None, None))
+            continue
+
+        if bg_sub_model is None:
+            bg_sub_model = bgsub.BackgroundExtractor(frame, conf, path_to_file)
+        locations = [tuple(int(v) for v in location) for location in bg_sub_model.detect_face(frame)]
+
+        if not ring.is_valid(slot, frame_number):
+            result_queue.put((frame_number, slot, timestamp, None, None))
+        elif len(locations) == 0:
+            result_queue.put((frame_number, slot, timestamp, [], []))
+        else:
+            recognition_queue.put((frame_number, slot, timestamp, locations))
+
+
+def run_recognition(ring, recognition_queue, result_queue, reload_event, conf):
+    """
+    Recognition worker process. Loads its own copy of the face recognition model. The worker does not watch
+    the gallery itself, it reloads it when the main process sets reload_event
+    """
+    face_recognizer = user_recognizer.UserRecognizer.create_face_recognizer(dict(conf, gallery_poll_interval=0))
+    while True:
+        task = recognition_queue.get()
+        if task is None:
+            break
+        if reload_event.is_set():
+            reload_event.clear()
+            face_recognizer.reload_gallery()
+        frame_number, slot, timestamp, locations = task
+        frame = ring.read(slot, frame_number)
+        names = face_recognizer.recognize_face(frame, locations) if frame is not None else None
+        if names is None or not ring.is_valid(slot, frame_number):
+            result_queue.put((frame_number, slot, timestamp, None, None))
+        else:
+            result_queue.put((frame_number, slot, timestamp, locations, names))
+
+
+class ProcessRecognitionPipeline:
+    """
+    Multi-process variant of pipeline.RecognitionPipeline. The capture thread writes frames into a shared memory
+    ring, detection and recognition run in worker processes that read the frames by slot index, and results
+    are reordered by frame number before they are returned by get_result.
+    Frames not answered within job_timeout seconds are given up on and dead workers are restarted,
+    so a crashed worker cannot stall the capture
+    """
+
+    def __init__(self, camera, conf, path_to_file):
+        """
+        :param camera: video source with a read() method
+        :param conf: configuration file, its "pipeline" section configures the workers
+        :param path_to_file: directory of working directory
+        """
+        pipeline_conf = conf["pipeline"]
+        self.camera = camera
+        self.reader = frame_source.FrameReader(camera)
+        self.capture_interval = 1 / float(pipeline_conf["capture_fps"])
+        self.reorder_window = pipeline_conf["reorder_window"]
+        self.job_timeout = pipeline_conf["job_timeout"]
+        self.conf = conf
+        self.path_to_file = path_to_file
+
+        self.frame_width = conf["frame_width"]
+        first_frame, _ = self.reader.read(timeout=None)
+        first_frame = frame_source.resize_to_width(first_frame, self.frame_width)
+        self.ring = SharedFrameRing(pipeline_conf["ring_slots"], first_frame.shape)
+        # at most ring_slots - 1 frames are in flight, so a slot is never overwritten while a worker needs it
+        self.max_in_flight = pipeline_conf["ring_slots"] - 1
+
+        self.task_queue = multiprocessing.Queue()
+        self.recognition_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+
+        # the background model is updated by every detection, so it must only be used by one process
+        detection_workers = 1 if conf["do_bgsub"] else pipeline_conf["detection_workers"]
+        self.reload_events = [multiprocessing.Event() for _ in range(pipeline_conf["recognition_workers"])]
+        self.detection_processes = [self.create_detection_worker() for _ in range(detection_workers)]
+        self.recognition_processes = [self.create_recognition_worker(i)
+                                      for i in range(pipeline_conf["recognition_workers"])]
+
+        self.duplicate_filter = frame_source.create_duplicate_filter(conf)
+        self.capture_thread = threading.Thread(target=self.capture, name="Capture")
+        self.capture_thread.daemon = True
+        self.running = False
+
+        self.frame_number = 0
+        # frame number -> (slot, capture time) of the frames the workers have not answered yet
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.skipped = 0
+        self.timed_out = 0
+        self.restarted = 0
+        self.invalid = 0
+        self.late = 0
+        self.next_result_number = 0
+        self.pending = []
+        self.end_to_end_latencies = collections.deque(maxlen=100)
+
+    def create_detection_worker(self):
+        return multiprocessing.Process(target=run_detection,
+                                       args=(self.ring, self.task_queue, self.recognition_queue, self.result_queue,
+                                             self.conf, self.path_to_file))
+
+    def create_recognition_worker(self, index):
+        return multiprocessing.Process(target=run_recognition,
+                                       args=(self.ring, self.recognition_queue, self.result_queue,
+                                             self.reload_events[index], self.conf))
+
+    def start(self):
+        self.running = True
+        for process in self.detection_processes + self.recognition_processes:
+            process.daemon = True
+            process.start()
+        self.capture_thread.start()
+
+    def stop(self):
+        self.running = False
+        for _ in self.detection_processes:
+            self.task_queue.put(None)
+        for _ in self.recognition_processes:
+            self.recognition_queue.put(None)
+        for process in self.detection_processes + self.recognition_processes:
+            process.join(1.0)
+
+    def reload_gallery(self):
+        """
+        Makes every recognition worker reload the gallery before its next frame.
+        Called by the main process after it reloaded the gallery, so the workers find the new encodings in the cache
+        :return: None
+        """
+        for event in self.reload_events:
+            event.set()
+
+    def restart_dead_workers(self):
+        """
+        Replaces worker processes that died, e.g. by a crash in native code. Their frames time out
+        :return: None
+        """
+        for i, process in enumerate(self.detection_processes):
+            if not process.is_alive():
+                self.detection_processes[i] = self.create_detection_worker()
+                self.detection_processes[i].daemon = True
+                self.detection_processes[i].start()
+                self.restarted += 1
+        for i, process in enumerate(self.recognition_processes):
+            if not process.is_alive():
+                self.recognition_processes[i] = self.create_recognition_worker(i)
+                self.recognition_processes[i].daemon = True
+                self.recognition_processes[i].start()
+                self.restarted += 1
+
+    def expire_jobs(self):
+        """
+        Gives up on the frames in flight for more than job_timeout seconds, so their slots are reused and
+        get_result does not wait for them. A result arriving later is dropped as late
+        :return: None
+        """
+        now = time.time()
+        with self.in_flight_lock:
+            expired = [(frame_number, slot, start) for frame_number, (slot, start) in self.in_flight.items()
+                       if now - start > self.job_timeout]
+            for frame_number, _, _ in expired:
+                del self.in_flight[frame_number]
+        for frame_number, slot, start in expired:
+            heapq.heappush(self.pending, (frame_number, slot, start, None, None))
+            self.timed_out += 1
+
+    def is_duplicate(self, frame):
+        return self.duplicate_filter is not None and self.duplicate_filter.is_duplicate(frame)
+
+    def capture(self):
+        while self.running:
+            start = time.time()
+            frame, timestamp = self.reader.read()
+            if frame is not None and not self.is_duplicate(frame):
+                with self.in_flight_lock:
+                    has_room = len(self.in_flight) < self.max_in_flight
+                if has_room:
+                    slot = self.ring.write(self.frame_number, frame_source.resize_to_width(frame, self.frame_width))
+                    with self.in_flight_lock:
+                        self.in_flight[self.frame_number] = (slot, timestamp)
+                    self.task_queue.put((self.frame_number, slot, timestamp))
+                    self.frame_number += 1
+                else:
+                    self.skipped += 1
+            elapsed = time.time() - start
+            if elapsed < self.capture_interval:
+                time.sleep(self.capture_interval - elapsed)
+
+    def receive(self, timeout):
+        """
+        Moves one result from the result queue to the reorder heap
+        :return: True if a result was received
+        """
+        try:
+            result = self.result_queue.get(timeout=timeout)
+        except Queue.Empty:
+            return False
+        with self.in_flight_lock:
+            if self.in_flight.pop(result[0], None) is None:
+                # timed out before, its place in the order is taken
+                self.late += 1
+                return True
+        heapq.heappush(self.pending, result)
+        return True
+
+    def count_duplicates(self):
+        """
+        Duplicate frames are only counted, they never become results and so never vote for a login
+        :return: number of duplicate frames skipped since the start
+        """
+        return self.duplicate_filter.skipped if self.duplicate_filter is not None else 0
+
+    def get_result(self, timeout=1.0):
+        """
+        Returns the next result in frame order. If a frame is missing while more than reorder_window
+        later results are waiting, it is given up on and dropped should it arrive later.
+        Frames overwritten before they were processed, or not answered in time, are skipped
+        :param timeout: seconds to wait for a result
+        :return: pipeline.FramePacket or None if no result arrived in time
+        """
+        deadline = time.time() + timeout
+        while True:
+            if self.running:
+                self.restart_dead_workers()
+            self.expire_jobs()
+            while len(self.pending) > 0 and (self.pending[0][0] <= self.next_result_number
+                                             or len(self.pending) > self.reorder_window):
+                frame_number, slot, timestamp, locations, names = heapq.heappop(self.pending)
+                if frame_number < self.next_result_number:
+                    # arrived after the reorder window gave up on it
+                    self.late += 1
+                    continue
+                self.next_result_number = frame_number + 1
+                if locations is None:
+                    self.invalid += 1
+                    continue
+                # the slot may be reused as soon as the result is received, a frame overwritten meanwhile is not shown
+                packet = pipeline.FramePacket(frame_number, self.ring.copy(slot, frame_number), timestamp)
+                packet.face_locations = locations
+                packet.face_names = names
+                self.end_to_end_latencies.append(time.time() - timestamp)
+                return packet
+
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.receive(min(remaining, self.job_timeout)):
+                if time.time() >= deadline:
+                    return None
+
+    def get_stats(self):
+        """
+        :return: dictionary with captured, skipped, invalid and timed out frame counts, restarted workers,
+                and end to end latency
+        """
+        stats = {"Captured": self.frame_number,
+                 "In_flight": len(self.in_flight),
+                 "Skipped": self.skipped,
+                 "Timed_out": self.timed_out,
+                 "Restarted_workers": self.restarted,
+                 "Invalid": self.invalid,
+                 "Late": self.late,
+                 "Reorder_pending": len(self.pending),
+                 "End_to_end_latency": utility.list_avg(list(self.end_to_end_latencies))}
+        if self.duplicate_filter is not None:
+            stats.update(self.duplicate_filter.get_stats())
+        return stats
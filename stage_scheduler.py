@@ -0,0 +1,74 @@
+import time
+
+
+class StageScheduler:
+    """
+    Decides per frame which stages of the recognition loop run, instead of processing every other frame in full.
+    Each stage of the "schedule" section has its own cadence and trigger conditions:
+        every: the stage runs at most once every that many frames it is asked about
+        requires: conditions that must all hold for the stage to run at all
+        triggers: conditions that make the stage run right away, regardless of its cadence
+    Conditions are named booleans the loop passes in, e.g. motion_started, woke_up, faces or logged_in.
+    Skipped stages leave their last results in place for the loop to reuse
+    """
+
+    def __init__(self, conf):
+        """
+        :param conf: configuration file, its "schedule" section configures the stages
+        """
+        self.stages = conf["schedule"]
+        # a stage is due on the first frame it is asked about
+        self.waited = {stage: float("inf") for stage in self.stages}
+        self.runs = {stage: 0 for stage in self.stages}
+        self.frames = 0
+        self.start_time = time.time()
+
+    def is_enabled(self, stage):
+        return self.stages[stage].get("enabled", True)
+
+    def set_every(self, stage, every):
+        """
+        Changes the cadence of a stage, e.g. when the adaptive controller changes the frame interval
+        :param stage: name of the stage
+        :param every: the stage runs once every that many frames
+        :return: None
+        """
+        self.stages[stage]["every"] = every
+
+    def next_frame(self):
+        """
+        Called once for every frame the loop handles, the rates are relative to these frames
+        :return: None
+        """
+        self.frames += 1
+
+    def should_run(self, stage, **conditions):
+        """
+        :param stage: name of the stage
+        :param conditions: current value of the conditions the stage may require or be triggered by,
+                conditions not given are False
+        :return: True if the stage runs on this frame
+        """
+        stage_conf = self.stages[stage]
+        if not self.is_enabled(stage) or not all(conditions.get(c, False) for c in stage_conf["requires"]):
+            return False
+        self.waited[stage] += 1
+        if self.waited[stage] < stage_conf["every"] and not any(conditions.get(c, False)
+                                                                for c in stage_conf["triggers"]):
+            return False
+        self.waited[stage] = 0
+        self.runs[stage] += 1
+        return True
+
+    def get_stats(self):
+        """
+        :return: for each stage the fraction of frames it ran on and the number of runs per second
+        """
+        frames = float(max(1, self.frames))
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        stats = {}
+        for stage, runs in self.runs.items():
+            name = stage.capitalize()
+            stats[name + "_rate"] = runs / frames
+            stats[name + "_fps"] = runs / elapsed
+        return stats
@@ -1,19 +1,22 @@
-import face_recognition
 import cv2
 import time
 import background_subtractor as bgsub
-import imutils
 import json
 import sys
 import inspect
 import os
 import signal
-from imutils.video import VideoStream
-import facenet_recognition
 import face_landmarks
-import opencv_modules
 import user_recognizer
 import nodejs_input
+import pipeline
+import process_pipeline
+import frame_source
+import frame_context
+import preview_server
+import idle_monitor
+import adaptive_controller
+import stage_scheduler
 
 
 def shutdown(self, signum):
@@ -25,15 +28,16 @@ def shutdown(self, signum):
 path_to_file = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 conf = json.load(open(path_to_file + '/conf.json'))
 
-if conf["use_rpi_camera"]:
-    camera = VideoStream(usePiCamera=conf["use_rpi_camera"] > 0).start()
-    signal.signal(signal.SIGINT, shutdown)
-    time.sleep(conf["camera_warmup_time"])
-else:
-    #camera = cv2.VideoCapture('http://{0}:2067/html/cam_pic_new.php'.format(conf["rpi_IP"]))
-    camera = VideoStream(src='http://{0}:2067/html/cam_pic_new.php'.format(conf["rpi_IP"])).start()
+camera = frame_source.open_camera(conf)
+signal.signal(signal.SIGINT, shutdown)
+time.sleep(conf["camera_warmup_time"])
 
 user_rec = user_recognizer.UserRecognizer(conf)
+headless = conf["headless"]
+show_recognition = conf["show_video"]["recognition"] and not headless
+preview = preview_server.create_preview_server(conf)
+if preview is not None:
+    preview.add_view("recognition", user_rec.draw_recognized_face)
 
 
 def get_names(user_indexes):
@@ -47,61 +51,210 @@ def get_names(user_indexes):
     for i in user_indexes:
         if i < 1:
             names.append("{0} Unknown".format(i))
+        elif i > len(users):
+            # enrolled while running, but not yet named in conf.json
+            names.append("{0}".format(i))
         else:
             names.append("{0} {1}".format(i, users[i-1]))
     return names
 
+
+def quit_requested():
+    """
+    Polls the highgui windows for 'q'. Headless runs have no windows and are stopped with SIGINT
+    :return: True if 'q' was pressed
+    """
+    if headless:
+        return False
+    return cv2.waitKey(1) & 0xFF == ord('q')
+
+
+def create_background_model(frame):
+    model = bgsub.BackgroundExtractor(frame, conf, path_to_file)
+    if preview is not None:
+        model.attach_preview(preview)
+    return model
+
+
+def publish_recognition(frame, face_locations, face_names):
+    if preview is not None and preview.is_watched("recognition"):
+        preview.publish("recognition", (frame, face_locations, get_names(face_names)))
+
 #cap.set(6, 5) cant remember what this does
 #cap.set(cv2.cv.CV_CAP_PROP_FPS, 5)
 
-#fl = face_landmarks.WinkClassifier()
-
 # Initialize some variables
 face_locations = []
 face_names = []
-process_this_frame = True
 bg_sub_model = None
-fps = 30
-limit_fps = False
 performance_stats = {}
+stats_time = time.time()
+duplicate_filter = frame_source.create_duplicate_filter(conf)
+idle = idle_monitor.create_idle_monitor(conf, camera)
+controller = adaptive_controller.create_adaptive_controller(conf)
+context_stats = frame_context.ContextStats()
+frame_width = conf["frame_width"] if controller is None else controller.frame_width
+# each stage runs at its own cadence, skipped stages reuse their last results
+scheduler = stage_scheduler.StageScheduler(conf)
+if controller is not None:
+    scheduler.set_every("detection", controller.frame_interval)
+fl = face_landmarks.WinkClassifier() if scheduler.is_enabled("landmarks") else None
+motion = False
+
+
+
+def run_pipeline():
+    """
+    Runs capture, detection and recognition as separate threaded stages, or worker processes when
+    the pipeline mode is "processes". This thread only consumes the results: login/logout checks and visualization
+    :return: None
+    """
+    if conf["pipeline"]["mode"] == "processes":
+        recognition_pipeline = process_pipeline.ProcessRecognitionPipeline(camera, conf, path_to_file)
+        if hasattr(user_rec.face_recognizer, "reload_listeners"):
+            # only this process watches the gallery, the workers reload it from the cache it updated
+            user_rec.face_recognizer.reload_listeners.append(recognition_pipeline.reload_gallery)
+    else:
+        first_frame, _ = frame_source.FrameReader(camera).read(timeout=None)
+        first_frame = frame_source.resize_to_width(first_frame, conf["frame_width"])
+        recognition_pipeline = pipeline.RecognitionPipeline(camera, user_rec, create_background_model(first_frame),
+                                                            conf)
+    recognition_pipeline.start()
+    stats_time = time.time()
+    duplicates = 0
+    last_names = []
+    print "Init recognition pipeline"
+    while True:
+        packet = recognition_pipeline.get_result()
+        if recognition_pipeline.count_duplicates() > duplicates:
+            # the faces of the last result are still in front of the camera, but give no new votes
+            duplicates = recognition_pipeline.count_duplicates()
+            user_rec.refresh_presence(last_names)
+        if packet is not None:
+            last_names = packet.face_names
+            user_rec.update_detection_list(packet.face_names)
+            user_rec.check_login()
+            if packet.frame is not None:
+                if show_recognition:
+                    user_rec.show_recognized_face(packet.frame, packet.face_locations, get_names(packet.face_names))
+                publish_recognition(packet.frame, packet.face_locations, packet.face_names)
+        user_rec.check_logout()
+
+        if time.time() - stats_time > conf["pipeline"]["stats_interval"]:
+            print recognition_pipeline.get_stats()
+            stats_time = time.time()
+        if quit_requested():
+            break
+    recognition_pipeline.stop()
+
+
+if conf["pipeline"]["enabled"]:
+    run_pipeline()
+    sys.exit(0)
+
+if controller is not None and hasattr(camera, "set_width"):
+    camera.set_width(frame_width)
 
+reader = frame_source.FrameReader(camera)
 print "Init recognition"
 while True:
-    # Grab a single frame of video
-    start_time = time.time()
-    frame = camera.read()
-    #print camera.read()
-    #ret, frame = camera.read()
+    # Grab a single frame of video, waiting for one newer than the last. Latency is measured from its arrival
+    frame, start_time = reader.read()
+    if frame is None:
+        user_rec.check_logout()
+        if quit_requested():
+            break
+        continue
+    if idle is not None:
+        if idle.check_idle(frame, start_time):
+            # nobody in front of the mirror, only look for motion at the idle rate
+            idle.wait(start_time)
+            if quit_requested():
+                break
+            continue
+    if duplicate_filter is not None and duplicate_filter.is_duplicate(frame):
+        # same picture as the previous frame: its faces are still there, but it is no new evidence for a login
+        user_rec.refresh_presence(face_names)
+        user_rec.check_logout()
+        if idle is not None:
+            # a still picture has no motion
+            idle.update(len(face_locations) > 0 or user_rec.current_user is not None, start_time)
+        if show_recognition or (preview is not None and preview.is_watched("recognition")):
+            frame = frame_source.resize_to_width(frame, frame_width)
+            if show_recognition:
+                user_rec.show_recognized_face(frame, face_locations, get_names(face_names))
+            publish_recognition(frame, face_locations, face_names)
+        performance_stats.update(duplicate_filter.get_stats())
+        if quit_requested():
+            break
+        continue
 
-    frame = imutils.resize(frame, width=500)
+    frame = frame_source.resize_to_width(frame, frame_width)
 
     if bg_sub_model is None:
-        bg_sub_model = bgsub.BackgroundExtractor(frame, conf, path_to_file)
+        bg_sub_model = create_background_model(frame)
+        if controller is not None:
+            bg_sub_model.min_face_size = controller.min_face_size
+
+    # the stages share the conversions of the frame
+    context = frame_context.FrameContext(frame)
+    scheduler.next_frame()
+    motion_started = False
+    if conf["do_bgsub"] and scheduler.should_run("motion"):
+        # keeps the background model current, detection reuses the regions when it runs on this frame
+        had_motion, motion = motion, len(bg_sub_model.analyze_motion(context)) > 0
+        motion_started = motion and not had_motion
 
-    # Only process every other frame of video to save time
+    process_this_frame = scheduler.should_run("detection", motion_started=motion_started,
+                                              woke_up=idle is not None and idle.waking)
     if process_this_frame:
-        face_locations = bg_sub_model.detect_face(frame)
-        face_names = user_rec.recognize_face(frame, face_locations)
-        #fl.update_facial_landmarks(frame, face_locations)
-        #fl.classify_current()
+        face_locations = bg_sub_model.detect_face(context)
+        if scheduler.should_run("recognition", faces=len(face_locations) > 0):
+            face_names = user_rec.recognize_face(context, face_locations)
+        elif len(face_names) != len(face_locations):
+            # the last names no longer fit the faces
+            face_names = [-1] * len(face_locations)
         user_rec.check_login()
         user_rec.check_logout()
+        if idle is not None:
+            motion = bg_sub_model.motion_regions > 0 if conf["do_bgsub"] else idle.has_motion(frame)
+            idle.update(motion or len(face_locations) > 0 or user_rec.current_user is not None, start_time)
 
-        #print "landmark execution time: " + str(fl.performance_stats["Landmarks"])
-
-    process_this_frame = not process_this_frame
+        if fl is not None and scheduler.should_run("landmarks", logged_in=user_rec.current_user is not None):
+            # only the face of the logged in user is classified
+            fl.update_facial_landmarks(context, [location for location, name in zip(face_locations, face_names)
+                                                 if name == user_rec.current_user][:1])
+            fl.classify_current()
+    context_stats.add(context)
  #   if conf["show_video"]["landmarks"]:
   #      fl.show_landmarks(frame)
 
-    if conf["show_video"]["recognition"]:
+    if show_recognition:
         user_rec.show_recognized_face(frame, face_locations, get_names(face_names))
-    else:
+    publish_recognition(frame, face_locations, face_names)
+    if time.time() - stats_time > conf["stats_interval"]:
+        performance_stats.update(user_rec.get_performance_stats())
+        performance_stats.update(bg_sub_model.get_performance_stats())
+        performance_stats.update(context_stats.get_stats())
+        if idle is not None:
+            performance_stats.update(idle.get_stats())
+        if controller is not None:
+            performance_stats.update(controller.get_stats())
+        performance_stats.update(scheduler.get_stats())
         print performance_stats
-    execution_time = time.time() - start_time
-    if limit_fps:
-        if execution_time < 1/float(fps):
-            time.sleep((1/float(fps)) - execution_time)
+        stats_time = time.time()
+
+    if controller is not None and controller.update(start_time, process_this_frame):
+        # apply the new processing level from the next frame on
+        frame_width = controller.frame_width
+        scheduler.set_every("detection", controller.frame_interval)
+        bg_sub_model.min_face_size = controller.min_face_size
+        if hasattr(camera, "set_width"):
+            camera.set_width(frame_width)
+        # face boxes at the old width no longer overlap the new ones
+        user_rec.reset_tracking()
+        bg_sub_model.reset_priors()
     # Hit 'q' on the keyboard to quit!
-    if cv2.waitKey(1) & 0xFF == ord('q'):
+    if quit_requested():
         break
 
@@ -6,10 +6,12 @@ import numpy as np
 
 import cv2
 from datetime import datetime
-import imutils
 import background_subtractor as bgsub
 import user_recognizer
 import utility
+import frame_source
+import frame_context
+import stage_scheduler
 
 path_to_file = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 conf = json.load(open(path_to_file + '/conf.json'))
@@ -38,8 +40,6 @@ def test_video(filename):
     print "Testing video {0}".format(filename)
     cap = cv2.VideoCapture(filename)
     cap.set(6, 5)
-    fps = 30
-    limit_fps = False
     debug = False
 
     face_locations = []
@@ -52,7 +52,9 @@ def test_video(filename):
     logout_frames = []
     bg_sub_model = None
 
-    process_this_frame = True
+    scheduler = stage_scheduler.StageScheduler(conf)
+    motion = False
+    context_stats = frame_context.ContextStats()
     image_read_times = []
     visualization_times = []
     num_found_faces = 0
@@ -69,15 +71,25 @@ def test_video(filename):
         if not success:
             continue
 
-        frame = imutils.resize(frame, width=500)
+        frame = frame_source.resize_to_width(frame, conf["frame_width"])
 
         if bg_sub_model is None:
             bg_sub_model = bgsub.BackgroundExtractor(frame, conf, path_to_file)
 
-        if process_this_frame:
-            face_locations = bg_sub_model.detect_face(frame)
+        context = frame_context.FrameContext(frame)
+        scheduler.next_frame()
+        motion_started = False
+        if conf["do_bgsub"] and scheduler.should_run("motion"):
+            had_motion, motion = motion, len(bg_sub_model.analyze_motion(context)) > 0
+            motion_started = motion and not had_motion
+
+        if scheduler.should_run("detection", motion_started=motion_started):
+            face_locations = bg_sub_model.detect_face(context)
             num_found_faces += len(face_locations)
-            face_names = dnr.recognize_face(frame, face_locations)
+            if scheduler.should_run("recognition", faces=len(face_locations) > 0):
+                face_names = dnr.recognize_face(context, face_locations)
+            elif len(face_names) != len(face_locations):
+                face_names = [-1] * len(face_locations)
             num_recognized_faces += len([x for x in face_names if x > 0])
             login = dnr.check_login()
             logout = dnr.check_logout()
@@ -90,11 +102,7 @@ def test_video(filename):
             s1 = time.time()
             dnr.show_recognized_face(frame, face_locations, get_names(face_names))
             visualization_times.append(time.time() - s1)
-        process_this_frame = not process_this_frame
-        execution_time = time.time() - start_time
-        if limit_fps:
-            if execution_time < 1 / float(fps):
-                time.sleep((1 / float(fps)) - execution_time)
+        context_stats.add(context)
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
@@ -111,6 +119,8 @@ def test_video(filename):
 
     accumulate_performance_stats(bg_sub_model.get_performance_stats())
     accumulate_performance_stats(dnr.get_performance_stats())
+    accumulate_performance_stats(context_stats.get_stats())
+    accumulate_performance_stats(scheduler.get_stats())
     accumulate_performance_stats({"num_found_faces": num_found_faces, "num_recognized_faces": num_recognized_faces})
     return {"logins": login_frames, "logouts": logout_frames}
 
@@ -167,7 +177,7 @@ def accumulate_performance_stats(stats):
         if performance_stats.has_key(key):
             performance_stats[key].append(stats[key])
         else:
-            performance_stats[key] = []
+            performance_stats[key] = [stats[key]]
 
 
 def summarize_score(score, conf):
@@ -205,6 +215,7 @@ def summarize_score(score, conf):
         print >>log_file, "Detection algorithm: {0}".format(bgsub.BackgroundExtractor.get_algorithm_text(conf["detection_algorithm"]))
         print >>log_file, "Recognition algorithm: {0}".format(user_recognizer.UserRecognizer.get_algorithm_text(conf["recognition_algorithm"]))
         print >>log_file, "Consecutive detection limit: {0}".format(conf["consecutive_detections"])
+        print >>log_file, "Required detections: {0}".format(conf["required_detections"] or conf["consecutive_detections"])
         if conf["recognition_algorithm"] == 4:
             print >>log_file, "Number of Faces per subject: {0}".format(conf["num_faces"])
 
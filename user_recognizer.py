@@ -1,4 +1,5 @@
 import time
+import threading
 import nodejs_input
 import mirror_messenger
 import cv2
@@ -6,24 +7,39 @@ import facenet_recognition
 import os
 import inspect
 import opencv_modules
+import face_tracker
+import face_quality
+import vote_window
 
 
 class UserRecognizer:
 
-    def __init__(self, conf):
-        self.algorithm = 0
-        self.face_recognizer = self.load_face_recognition_algorithm(conf)
+    def __init__(self, conf, face_recognizer=None, rpi_ip=None):
+        """
+        :param conf: configuration file
+        :param face_recognizer: already loaded face recognition model to share, e.g. between cameras.
+                Loaded from conf if None
+        :param rpi_ip: IP of the mirror receiving the login events, defaults to conf["rpi_IP"]
+        """
+        self.algorithm = conf["recognition_algorithm"]
+        self.face_recognizer = face_recognizer if face_recognizer is not None \
+            else self.load_face_recognition_algorithm(conf)
 
         self.time_since_face_recognized = 0
         self.logout_time = conf["logout_time"]
-        self.consecutive_detection_limit = conf["consecutive_detections"]
-        self.detection_index = 0
+        self.votes = vote_window.VoteWindow(conf["consecutive_detections"], conf["required_detections"] or None)
         self.allow_strangers = conf["allow_strangers"]
 
+        self.tracker = face_tracker.FaceTracker(conf["tracking"]) if conf["tracking"]["enabled"] else None
+        self.tracker_lock = threading.Lock()
+
         self.current_user = None
-        self.recent_faces_recognized = []
-        self.reset_recognized_faces()
-        self.messenger = mirror_messenger.MirrorMessenger(conf["rpi_IP"])
+        self.messenger = mirror_messenger.MirrorMessenger(rpi_ip if rpi_ip is not None else conf["rpi_IP"])
+
+        # set by the gallery watcher thread, handled by check_logout on the thread running the login state machine
+        self.users_changed = threading.Event()
+        if hasattr(self.face_recognizer, "users_changed_listeners"):
+            self.face_recognizer.users_changed_listeners.append(self.users_changed.set)
 
     def load_face_recognition_algorithm(self, conf):
         """
@@ -32,11 +48,22 @@ class UserRecognizer:
         :return: loaded face recognition model
         """
         self.algorithm = conf["recognition_algorithm"]
-        if self.algorithm == 4:
+        return self.create_face_recognizer(conf)
+
+    @staticmethod
+    def create_face_recognizer(conf):
+        """
+        Creates the face recognition model given by key "recognition_algorithm", without any login state.
+        Used by worker processes that only recognize faces
+        :param conf: configuration file
+        :return: loaded face recognition model
+        """
+        algorithm = conf["recognition_algorithm"]
+        if algorithm == 4:
             path_to_file = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
             model = facenet_recognition.FacenetRecognizer(path_to_file + "/images/", conf)
         else:
-            model = opencv_modules.FaceRecModel(algorithm=self.algorithm)
+            model = opencv_modules.FaceRecModel(algorithm=algorithm)
         return model
 
     @staticmethod
@@ -57,53 +84,97 @@ class UserRecognizer:
             return "Google Facenet"
 
     def get_performance_stats(self):
-        return self.face_recognizer.get_average_stats()
+        stats = self.face_recognizer.get_average_stats()
+        if self.tracker is not None:
+            stats["Tracked_encoded_faces"] = self.tracker.stats["encoded"]
+            stats["Tracked_reused_faces"] = self.tracker.stats["reused"]
+        return stats
+
+    def reset_tracking(self):
+        """
+        Forgets the tracked faces, e.g. after the processing resolution changed
+        :return: None
+        """
+        if self.tracker is not None:
+            with self.tracker_lock:
+                self.tracker.reset()
 
     def reset_recognized_faces(self):
-        self.recent_faces_recognized = [[-2]] * self.consecutive_detection_limit
+        self.votes.clear()
 
     def recognize_face(self, frame, face_locations):
         """
         checks whether there is a known face in the frame
-        :param frame: current frame
+        :param frame: current frame, or its FrameContext
         :param face_locations: a list of (top, right, bottom, left)? tuples
         :return: a list of (name, index) tuples for the found faces
         """
-        indexes = self.face_recognizer.recognize_face(frame, face_locations)
+        indexes = self.identify_faces(frame, face_locations)
         self.update_detection_list(indexes)
 
         return indexes
 
+    def identify_faces(self, frame, face_locations):
+        """
+        Finds the user index of each face without updating the login state. Safe to call from several threads
+        When tracking is enabled only the faces whose track is new or stale are recognized,
+        the other tracks reuse their identity. A stale track whose face fails the quality gate keeps its previous
+        identity, a new one is face_quality.LOW_QUALITY until a good view of the face is encoded
+        :param frame: current frame
+        :param face_locations: a list of (top, right, bottom, left) tuples
+        :return: a list of user indexes for the found faces
+        """
+        if self.tracker is None:
+            return self.face_recognizer.recognize_face(frame, face_locations)
+
+        with self.tracker_lock:
+            tracks, stale = self.tracker.update(face_locations)
+        if len(stale) > 0:
+            users = self.face_recognizer.recognize_face(frame, [face_locations[i] for i in stale])
+            encoded = [(tracks[i], user) for i, user in zip(stale, users) if user != face_quality.LOW_QUALITY]
+            with self.tracker_lock:
+                self.tracker.set_identities([track for track, _ in encoded], [user for _, user in encoded])
+        return [track.user if track.last_encoded is not None else face_quality.LOW_QUALITY for track in tracks]
+
+    def refresh_presence(self, indexes):
+        """
+        Keeps the logged in user from being logged out while faces are present, without voting for a login.
+        Used for faces that are no new evidence, e.g. those of a duplicate frame
+        :param indexes: user indexes of the faces present
+        :return: None
+        """
+        if len(indexes) > 0:
+            self.time_since_face_recognized = time.time()
+
     def update_detection_list(self, indexes):
         """
         updates the list and index of recent faces detected
+        Faces that were not encoded because of their low quality keep the user logged in, but give no vote
         :param indexes: list indexes to update
         :return: None
         """
+        self.refresh_presence(indexes)
+        indexes = [index for index in indexes if index != face_quality.LOW_QUALITY]
         if len(indexes) > 0:
-            self.recent_faces_recognized[self.detection_index] = indexes
-            self.detection_index = (self.detection_index + 1) % self.consecutive_detection_limit
-            self.time_since_face_recognized = time.time()
+            self.votes.add(indexes)
 
     def check_login(self):
         """
         checks if the conditions for a login-event are met, if so, sends login-event to nodeJS
         conditions:
-            1. list of recently detected faces must be same for all elements
-            2. the new user to login must differ from user already logged in
-            3. list of recently detected faces must be full
+            1. the user must be recognized in required_detections of the last consecutive_detections frames with
+            faces, in all of them when required_detections is 0
+            2. no user is logged in
         :return: index of logged in user or False
         """
-        same_user, index = self.are_all_same_user(self.recent_faces_recognized, self.consecutive_detection_limit)
+        index_limit = -2 if self.allow_strangers else 0
+        index = self.votes.get_user(index_limit)
 
-        if same_user:
-            if self.current_user is None:
-                index_limit = -2 if self.allow_strangers else 0
-                if index > index_limit:
-                    self.current_user = index
-                    nodejs_input.to_node("login", {"user": self.current_user})
-                    self.messenger.send_to_mirror("login", {"user": self.current_user})
-                    return self.current_user
+        if index is not None and self.current_user is None:
+            self.current_user = index
+            nodejs_input.to_node("login", {"user": self.current_user})
+            self.messenger.send_to_mirror("login", {"user": self.current_user})
+            return self.current_user
 
         return False
 
@@ -111,12 +182,20 @@ class UserRecognizer:
         """
         checks if the conditions for a logout-event are met, if so send logout-event to nodeJS
         conditions:
-            1. the elapsed time from when the last face was recognized must be greater than self.logout_time
+            1. the elapsed time from when the last face was recognized must be greater than self.logout_time,
+            or a gallery reload gave the user indexes to other users
             2. a user must be logged in
+        When the user indexes changed the votes and tracked identities, which refer to the old indexes, are cleared
         :return: True or False. A user either logged out, or didn't
         """
         user = False
-        if time.time() - self.time_since_face_recognized > self.logout_time and self.current_user is not None:
+        users_changed = self.users_changed.is_set()
+        if users_changed:
+            self.users_changed.clear()
+            self.reset_recognized_faces()
+            self.reset_tracking()
+        if (users_changed or time.time() - self.time_since_face_recognized > self.logout_time) \
+                and self.current_user is not None:
             nodejs_input.to_node("logout", {"user": self.current_user})
             self.messenger.send_to_mirror("logout", {"user": self.current_user})
 
@@ -125,33 +204,18 @@ class UserRecognizer:
             self.current_user = None
         return user
 
-    def are_all_same_user(self, users, detection_limit):
+    @staticmethod
+    def draw_recognized_face(image_frame, face_locations, face_names):
         """
-        Detects if the same user has been detected detection_limit amount of times in a row
-        :param users: A nested list of users indexes [[1, 2], [1]...]
-        :param detection_limit: number of consecutive detections for logint to trigger
-        :return: True or False
+        :return: copy of image_frame with the faces boxed and labelled with their names
         """
-        user_count = {}
-        for i in range(self.consecutive_detection_limit):
-            for j in users[i]:
-                if user_count.has_key(j):
-                    user_count[j] += 1
-                else:
-                    user_count[j] = 1
-
-        for key in user_count.keys():
-            if user_count[key] == detection_limit:
-                return True, key
-
-        return False, -2
-
-    def show_recognized_face(self, image_frame, face_locations, face_names):
         frame = image_frame.copy()
         for (top, right, bottom, left), name in zip(face_locations, face_names):
             cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
             font = cv2.FONT_HERSHEY_COMPLEX_SMALL
             cv2.putText(frame, str(name), (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1)
+        return frame
 
-        cv2.imshow('Video', frame)
+    def show_recognized_face(self, image_frame, face_locations, face_names, window='Video'):
+        cv2.imshow(window, self.draw_recognized_face(image_frame, face_locations, face_names))
 
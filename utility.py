@@ -1,4 +1,5 @@
 import os
+import re
 import numpy as np
 
 def list_avg(l):
@@ -28,6 +29,26 @@ def get_sorted_directory(folder):
     return sorted(os.listdir(folder))
 
 
+def get_user_indexes(directories):
+    """
+    Takes the user index from the numeric prefix of each user folder, e.g. 003_emil is user 3, so the index of a
+    user does not change when other users are added or removed. Folders without a prefix, or repeating one, are
+    numbered after the largest prefix, in the given order
+    :param directories: sorted names of the user folders
+    :return: list of user indexes aligned with directories
+    """
+    prefixes = [re.match(r"\d+", directory) for directory in directories]
+    next_index = max([int(prefix.group()) for prefix in prefixes if prefix is not None] + [0]) + 1
+    indexes = []
+    for prefix in prefixes:
+        index = int(prefix.group()) if prefix is not None else None
+        if index is None or index == 0 or index in indexes:
+            index = next_index
+            next_index += 1
+        indexes.append(index)
+    return indexes
+
+
 def most_common_element(lst):
     """
     Finds the most common element in a list. Break ties randomly
@@ -70,5 +91,47 @@ def convert_opencv_location_to_dlib(location):
 def _opencv_to_dlib(location):
     if len(location) == 0:
         return ()
-    x, y, w, h = location.astype(np.int64)
+    x, y, w, h = np.asarray(location).astype(np.int64)
     return y, w + x, y + h, x
+
+
+def pad_box(box, padding, frame_shape):
+    """
+    Grows a box on every side by a fraction of its size, clipped to the frame
+    :param box: opencv rect (x, y, w, h)
+    :param padding: fraction of the width and height added on each side
+    :param frame_shape: shape of the frame (height, width, ...)
+    :return: padded opencv rect (x, y, w, h), empty if the box lies outside the frame
+    """
+    x, y, w, h = box
+    pad_x, pad_y = int(w * padding), int(h * padding)
+    left, top = max(0, x - pad_x), max(0, y - pad_y)
+    right, bottom = min(frame_shape[1], x + w + pad_x), min(frame_shape[0], y + h + pad_y)
+    return left, top, max(0, right - left), max(0, bottom - top)
+
+
+def merge_boxes(boxes, distance=0):
+    """
+    Replaces boxes that overlap or are at most distance pixels apart by their union, until no such pair is left
+    :param boxes: list of opencv rects (x, y, w, h)
+    :param distance: largest gap in pixels between boxes that are merged
+    :return: list of disjoint opencv rects
+    """
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                x1, y1, w1, h1 = boxes[i]
+                x2, y2, w2, h2 = boxes[j]
+                if x1 - distance <= x2 + w2 and x2 - distance <= x1 + w1 and \
+                        y1 - distance <= y2 + h2 and y2 - distance <= y1 + h1:
+                    left, top = min(x1, x2), min(y1, y2)
+                    boxes[i] = (left, top, max(x1 + w1, x2 + w2) - left, max(y1 + h1, y2 + h2) - top)
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
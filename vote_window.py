@@ -0,0 +1,65 @@
+class VoteWindow:
+    """
+    Sliding window over the users recognized in the last size frames, kept as a ring buffer.
+    For every user the window counts the frames the user appears in. The counts are updated when a frame enters the
+    window and when the oldest frame is evicted, and the users counted in at least required frames are kept in a set,
+    so the cost of a frame depends on the number of faces in it and not on the size of the window.
+    A user appearing several times in one frame is counted once for that frame
+    """
+
+    def __init__(self, size, required=None):
+        """
+        :param size: number of frames in the window
+        :param required: number of frames of the window a user must appear in, all of them if None (strict rule)
+        """
+        self.size = size
+        self.required = size if required is None else required
+        if not 0 < self.required <= size:
+            raise ValueError("required must be between 1 and the window size {0}, got {1}".format(size, self.required))
+        self.frames = None
+        self.index = 0
+        self.counts = {}
+        self.qualified = set()
+        self.clear()
+
+    def clear(self):
+        # tuples, so the empty slots share no mutable state
+        self.frames = [()] * self.size
+        self.index = 0
+        self.counts = {}
+        self.qualified = set()
+
+    def add(self, users):
+        """
+        Adds the users of a new frame, evicting the oldest frame once the window is full
+        :param users: indexes of the users recognized in the frame
+        :return: None
+        """
+        for user in self.frames[self.index]:
+            count = self.counts[user] - 1
+            if count == 0:
+                del self.counts[user]
+            else:
+                self.counts[user] = count
+            if count < self.required:
+                self.qualified.discard(user)
+
+        users = tuple(set(users))
+        for user in users:
+            count = self.counts.get(user, 0) + 1
+            self.counts[user] = count
+            if count >= self.required:
+                self.qualified.add(user)
+        self.frames[self.index] = users
+        self.index = (self.index + 1) % self.size
+
+    def get_user(self, index_limit=None):
+        """
+        :param index_limit: only users with a greater index are considered, e.g. to leave out unknown faces (-1)
+        :return: the user appearing in at least required frames of the window, the one appearing most often if there
+                are several, or None
+        """
+        qualified = [user for user in self.qualified if index_limit is None or user > index_limit]
+        if len(qualified) == 0:
+            return None
+        return max(qualified, key=lambda user: (self.counts[user], user))